@@ -1,14 +1,83 @@
+import asyncio
 import codecs
+import functools
+import json
+import logging
 import pickle
 import time
-from threading import Lock
+import uuid
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Optional, Any, Tuple, List, Callable, Dict
 
 import cuwais.database
 import redis
+import redis.asyncio
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import database
+
+REDIS_HOST = 'redis'
+REDIS_PORT = 6379
+REDIS_MAX_CONNECTIONS = 64
+
+# Blocking pools wait for a free connection rather than failing when every connection is in use
+redis_pool = redis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, max_connections=REDIS_MAX_CONNECTIONS)
+redis_connection = redis.Redis(connection_pool=redis_pool)
+async_redis_pool = redis.asyncio.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT,
+                                                        max_connections=REDIS_MAX_CONNECTIONS)
+async_redis_connection = redis.asyncio.Redis(connection_pool=async_redis_pool)
 
-redis_connection = redis.Redis(host='redis', port=6379)
 _id_count = 0
 _id_mutex = Lock()
+_cache_infos = {}
+_local_caches = []
+_subscriptions: Dict[str, Callable[[dict], None]] = {}
+_subscriber_thread = None
+
+INVALIDATIONS_CHANNEL = "cache-invalidations"
+
+# Only delete a lease if we still own it, otherwise we could release a lease that expired and was taken by another worker
+_RELEASE_LEASE_LUA = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+_release_lease_script = redis_connection.register_script(_RELEASE_LEASE_LUA)
+_async_release_lease_script = async_redis_connection.register_script(_RELEASE_LEASE_LUA)
+
+# Stores an entry and adds it to its tag sets, unless one of its tags was invalidated since the value started being
+# computed, as the value may then have been computed from the old data.
+# KEYS are the entry, then its n tag sets, then their n generations; ARGV is the value, the expiry, then the n generations
+# read before computing. Tag sets must live at least as long as the longest lived entry they point to
+_STORE_LUA = """
+local n = (#KEYS - 1) / 2
+for i = 1, n do
+    if (redis.call("get", KEYS[1 + n + i]) or "0") ~= ARGV[2 + i] then
+        return 0
+    end
+end
+redis.call("set", KEYS[1], ARGV[1], "ex", ARGV[2])
+for i = 1, n do
+    redis.call("sadd", KEYS[1 + i], KEYS[1])
+    if redis.call("ttl", KEYS[1 + i]) < tonumber(ARGV[2]) then
+        redis.call("expire", KEYS[1 + i], ARGV[2])
+    end
+end
+return 1
+"""
+_store_script = redis_connection.register_script(_STORE_LUA)
+_async_store_script = async_redis_connection.register_script(_STORE_LUA)
+
+# Generations must outlive any computation which read them, or an invalidation could be forgotten
+_GENERATION_TTL = 24 * 60 * 60
+
+_LEASE_POLL_INTERVAL = 0.05
+
+# Strong references to background refreshes, as the event loop only keeps weak references to tasks
+_background_tasks = set()
 
 
 def _get_new_id():
@@ -20,51 +89,612 @@ def _get_new_id():
     return func_id
 
 
-def cached(ttl=5*60):
+def _make_key(func_id: int, args, kwargs) -> str:
+    id_str = f"cached-function-value-{func_id}"
+    if len(args) != 0:
+        id_str += codecs.encode(pickle.dumps(args), "base64").decode()
+    if len(kwargs) != 0:
+        id_str += codecs.encode(pickle.dumps(kwargs), "base64").decode()
+    return id_str
+
+
+def try_acquire_lease(id_str: str, lease_ttl: float) -> Optional[str]:
+    """Attempts to become the single worker computing the value for the given key.
+    Returns a token to release the lease with, or None if another worker holds the lease"""
+    token = uuid.uuid4().hex
+    if redis_connection.set(id_str + "-lease", token, nx=True, px=int(lease_ttl * 1000)):
+        return token
+    return None
+
+
+def release_lease(id_str: str, token: str):
+    _release_lease_script(keys=[id_str + "-lease"], args=[token])
+
+
+async def async_try_acquire_lease(id_str: str, lease_ttl: float) -> Optional[str]:
+    token = uuid.uuid4().hex
+    if await async_redis_connection.set(id_str + "-lease", token, nx=True, px=int(lease_ttl * 1000)):
+        return token
+    return None
+
+
+async def async_release_lease(id_str: str, token: str):
+    await _async_release_lease_script(keys=[id_str + "-lease"], args=[token])
+
+
+_TAG_KEY_PREFIX = "cached-tag-"
+_GENERATION_KEY_PREFIX = "cached-generation-"
+
+
+def _tag_key(tag: str) -> str:
+    return _TAG_KEY_PREFIX + tag
+
+
+def _generation_key(tag_key: str) -> str:
+    return _GENERATION_KEY_PREFIX + tag_key[len(_TAG_KEY_PREFIX):]
+
+
+def _parse_generations(generations) -> List[str]:
+    return ["0" if generation is None else generation.decode() for generation in generations]
+
+
+def _get_generations(tag_keys: List[str]) -> List[str]:
+    if len(tag_keys) == 0:
+        return []
+    return _parse_generations(redis_connection.mget([_generation_key(tag_key) for tag_key in tag_keys]))
+
+
+async def _async_get_generations(tag_keys: List[str]) -> List[str]:
+    if len(tag_keys) == 0:
+        return []
+    return _parse_generations(await async_redis_connection.mget([_generation_key(tag_key) for tag_key in tag_keys]))
+
+
+def _drop_local(keys):
+    for local_cache in _local_caches:
+        for key in keys:
+            local_cache.delete(key)
+
+
+def _on_invalidation_message(message):
+    _drop_local(json.loads(message["data"]))
+
+
+def invalidate(*tags: str):
+    """Removes every cached value tagged with any of the given tags, in redis and in every worker's local tier"""
+    if len(tags) == 0:
+        return
+
+    tag_keys = [_tag_key(tag) for tag in tags]
+    pipe = redis_connection.pipeline()
+    for tag_key in tag_keys:
+        pipe.smembers(tag_key)
+    pipe.delete(*tag_keys)
+    # Stops values being computed right now from being stored
+    for tag_key in tag_keys:
+        pipe.incr(_generation_key(tag_key))
+        pipe.expire(_generation_key(tag_key), _GENERATION_TTL)
+    members = (pipe.execute())[:len(tag_keys)]
+
+    keys = list({key.decode() for tag_members in members for key in tag_members})
+    if len(keys) == 0:
+        return
+
+    redis_connection.delete(*keys)
+    _drop_local(keys)
+    redis_connection.publish(INVALIDATIONS_CHANNEL, json.dumps(keys))
+
+
+async def async_invalidate(*tags: str):
+    if len(tags) == 0:
+        return
+
+    tag_keys = [_tag_key(tag) for tag in tags]
+    pipe = async_redis_connection.pipeline()
+    for tag_key in tag_keys:
+        pipe.smembers(tag_key)
+    pipe.delete(*tag_keys)
+    # Stops values being computed right now from being stored
+    for tag_key in tag_keys:
+        pipe.incr(_generation_key(tag_key))
+        pipe.expire(_generation_key(tag_key), _GENERATION_TTL)
+    members = (await pipe.execute())[:len(tag_keys)]
+
+    keys = list({key.decode() for tag_members in members for key in tag_members})
+    if len(keys) == 0:
+        return
+
+    await async_redis_connection.delete(*keys)
+    _drop_local(keys)
+    await async_redis_connection.publish(INVALIDATIONS_CHANNEL, json.dumps(keys))
+
+
+def invalidate_on_commit(db_session: Session, *tags: str):
+    """Invalidates the given tags once the session commits, so that values can't be recomputed from the old data"""
+    db_session.info.setdefault("cache_invalidations", set()).update(tags)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(db_session: Session):
+    tags = db_session.info.pop("cache_invalidations", None)
+    if tags:
+        invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(db_session: Session):
+    db_session.info.pop("cache_invalidations", None)
+
+
+def subscribe(channel: str, handler: Callable[[dict], None]):
+    """Registers a handler for a redis pub/sub channel. Must be called before start_subscriptions"""
+    _subscriptions[channel] = handler
+
+
+def start_subscriptions():
+    """Starts listening to every subscribed channel on a background thread, once per process"""
+    global _subscriber_thread
+    if _subscriber_thread is not None:
+        return
+
+    pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**_subscriptions)
+    _subscriber_thread = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+subscribe(INVALIDATIONS_CHANNEL, _on_invalidation_message)
+
+
+def get_many(keys: List[str]) -> List[Optional[Any]]:
+    """Fetches many cached entries in a single round trip, returning None for each missing key"""
+    if len(keys) == 0:
+        return []
+    values = redis_connection.mget(keys)
+    return [None if v is None else pickle.loads(v) for v in values]
+
+
+async def async_get_many(keys: List[str]) -> List[Optional[Any]]:
+    """Fetches many cached entries in a single round trip, returning None for each missing key"""
+    if len(keys) == 0:
+        return []
+    values = await async_redis_connection.mget(keys)
+    return [None if v is None else pickle.loads(v) for v in values]
+
+
+def get_cache_stats() -> dict:
+    return {name: cache_info() for name, cache_info in _cache_infos.items()}
+
+
+class LocalCache:
+    """A bounded, thread safe, in-process LRU cache where every entry expires after ttl seconds"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._mutex = Lock()
+
+    def get(self, key: str, default=None):
+        with self._mutex:
+            item = self._entries.get(key, None)
+            if item is not None:
+                expires, value = item
+                if expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        expires = time.time() + (self.ttl if ttl is None else min(ttl, self.ttl))
+        with self._mutex:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._mutex:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._mutex:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _CacheLayers:
+    """The state shared by the sync and async cache decorators: the in-process tier and the hit/miss counters"""
+    def __init__(self, f, ttl, stale_ttl, local_ttl, local_maxsize, tags):
+        self.func_id = _get_new_id()
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.tags = tags
+        self.local_cache = LocalCache(local_maxsize, local_ttl) if local_ttl is not None else None
+        self.hits = 0
+        self.misses = 0
+        _cache_infos[f.__qualname__] = self.cache_info
+        if self.local_cache is not None:
+            _local_caches.append(self.local_cache)
+
+    def key(self, args, kwargs) -> str:
+        return _make_key(self.func_id, args, kwargs)
+
+    def tag_keys(self, args, kwargs) -> List[str]:
+        if self.tags is None:
+            return []
+        tags = self.tags(*args, **kwargs) if callable(self.tags) else self.tags
+        return [_tag_key(tag) for tag in tags]
+
+    def get_local(self, id_str):
+        if self.local_cache is None:
+            return None
+        return self.local_cache.get(id_str)
+
+    def set_local(self, id_str, entry):
+        if self.local_cache is not None:
+            self.local_cache.set(id_str, entry, ttl=(entry["time"] + self.ttl) - time.time())
+
+    def count(self, entry):
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def is_fresh(self, entry) -> bool:
+        return (entry["time"] + self.ttl) > time.time()
+
+    def make_entry(self, value) -> Tuple[dict, bytes]:
+        entry = {"time": time.time(), "value": value}
+        return entry, pickle.dumps(entry)
+
+    def store_args(self, id_str, data: bytes, tag_keys: List[str], generations: List[str]) -> dict:
+        return {"keys": [id_str, *tag_keys, *[_generation_key(tag_key) for tag_key in tag_keys]],
+                "args": [data, self.expiry, *generations]}
+
+    def prime_many(self, args_list: List[tuple], compute_many: Callable[[List[tuple]], List[Any]]):
+        """Computes and stores the values for many sets of positional arguments whether or not they are cached, e.g. to
+        write them through as soon as what they depend on changes. Always talks to redis synchronously"""
+        keys = [self.key(args, {}) for args in args_list]
+        tag_keys = [self.tag_keys(args, {}) for args in args_list]
+        all_generations = iter(_get_generations([tag_key for keys_of_one in tag_keys for tag_key in keys_of_one]))
+        generations = [[next(all_generations) for _ in keys_of_one] for keys_of_one in tag_keys]
+
+        values = compute_many(args_list)
+        pipe = redis_connection.pipeline(transaction=False)
+        entries = []
+        for id_str, value, entry_tag_keys, entry_generations in zip(keys, values, tag_keys, generations):
+            entry, data = self.make_entry(value)
+            _store_script(**self.store_args(id_str, data, entry_tag_keys, entry_generations), client=pipe)
+            entries.append(entry)
+        for id_str, entry, stored in zip(keys, entries, pipe.execute()):
+            if stored:
+                self.set_local(id_str, entry)
+
+    @property
+    def expiry(self) -> int:
+        # Keep the entry around for long enough to be served while stale
+        return int(self.ttl + self.stale_ttl)
+
+    def cache_info(self):
+        info = {"redis_hits": self.hits, "redis_misses": self.misses}
+        if self.local_cache is not None:
+            info = {**info, "local_hits": self.local_cache.hits, "local_misses": self.local_cache.misses,
+                    "local_size": len(self.local_cache), "local_maxsize": self.local_cache.maxsize}
+        return info
+
+
+def cached(ttl=5*60, stale_ttl=60, lease_ttl=30, local_ttl=None, local_maxsize=128, tags=None):
+    """Caches the result of a function in redis, shared between all workers.
+
+    Values older than ttl are stale: for a further stale_ttl seconds they are still returned immediately while a single
+    worker recomputes the value in the background. Only one worker computes any given key at a time, holding a lease
+    for at most lease_ttl seconds; other callers wait for its result rather than duplicating the work.
+
+    If local_ttl is given then fresh values are also kept in an in-process LRU of at most local_maxsize entries for
+    local_ttl seconds, so repeated reads in the same worker don't touch redis at all. Values from the local tier are
+    shared between callers so must not be mutated.
+    Hit and miss counts for both layers are available from the decorated function's cache_info().
+
+    tags is either a list of strings or a function taking the same arguments as the decorated function and returning
+    one. Calling invalidate with any of an entry's tags removes that entry, and stops any value already being computed
+    for it from being stored.
+
+    The decorated function's get_many looks up the values for many sets of positional arguments with a single MGET, and
+    computes all the values which are missing or stale with one call to a given batch function. Its prime_many computes
+    and stores values the same way whether or not they are cached."""
     def decorator(f):
-        mutex = Lock()
-        func_id = _get_new_id()
+        layers = _CacheLayers(f, ttl, stale_ttl, local_ttl, local_maxsize, tags)
+
+        def store(pipe, id_str, value, tag_keys, generations):
+            entry, data = layers.make_entry(value)
+            _store_script(**layers.store_args(id_str, data, tag_keys, generations), client=pipe)
+            return entry
 
         def try_get(id_str):
             cached_entry = redis_connection.get(id_str)
 
             if cached_entry is not None:
                 cached_entry = pickle.loads(cached_entry)
-                cached_time = cached_entry["time"]
-                cached_value = cached_entry["value"]
+            layers.count(cached_entry)
 
-                # Check cached value is valid
-                now = time.time()
-                if (cached_time + ttl) > now:  # Timeout not elapsed
-                    return cached_value
+            return cached_entry
+
+        def compute(id_str, args, kwargs):
+            tag_keys = layers.tag_keys(args, kwargs)
+            generations = _get_generations(tag_keys)
+
+            # Calculate the value
+            value = f(*args, **kwargs)
 
+            # Set
+            pipe = redis_connection.pipeline(transaction=False)
+            entry = store(pipe, id_str, value, tag_keys, generations)
+            stored, = pipe.execute()
+            if stored:
+                layers.set_local(id_str, entry)
+
+            return value
+
+        def refresh(id_str, token, args, kwargs):
+            try:
+                compute(id_str, args, kwargs)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                release_lease(id_str, token)
+
+        def wait_for_value(id_str):
+            # Another worker holds the lease, so wait for it to produce the value
+            give_up = time.time() + lease_ttl
+            while time.time() < give_up:
+                time.sleep(_LEASE_POLL_INTERVAL)
+                entry = try_get(id_str)
+                if entry is not None:
+                    return entry
+                if not redis_connection.exists(id_str + "-lease"):
+                    break
             return None
 
+        @functools.wraps(f)
         def decorated(*args, **kwargs):
-            id_str = f"cached-function-value-{func_id}"
-            if len(args) != 0:
-                id_str += codecs.encode(pickle.dumps(args), "base64").decode()
-            if len(kwargs) != 0:
-                id_str += codecs.encode(pickle.dumps(kwargs), "base64").decode()
+            id_str = layers.key(args, kwargs)
+
+            entry = layers.get_local(id_str)
+            if entry is not None:
+                return entry["value"]
+
+            entry = try_get(id_str)
+            if entry is not None:
+                # Check cached value is valid
+                if layers.is_fresh(entry):  # Timeout not elapsed
+                    layers.set_local(id_str, entry)
+                    return entry["value"]
+
+                # Stale, so serve the old value while one worker refreshes it
+                token = try_acquire_lease(id_str, lease_ttl)
+                if token is not None:
+                    Thread(target=refresh, args=(id_str, token, args, kwargs), daemon=True).start()
+                return entry["value"]
+
+            token = try_acquire_lease(id_str, lease_ttl)
+            if token is None:
+                entry = wait_for_value(id_str)
+                if entry is not None:
+                    return entry["value"]
+
+                # The worker holding the lease failed or is taking too long, so compute it ourselves
+                return compute(id_str, args, kwargs)
 
-            mutex.acquire()
             try:
-                value = try_get(id_str)
-                if value is not None:
-                    return value
+                return compute(id_str, args, kwargs)
+            finally:
+                release_lease(id_str, token)
+
+        def get_many_values(args_list: List[tuple], compute_many: Callable[[List[tuple]], List[Any]]) -> List[Any]:
+            keys = [layers.key(args, {}) for args in args_list]
+            values: List[Any] = [None] * len(keys)
+            missing = []
+
+            remote = []
+            for i, id_str in enumerate(keys):
+                entry = layers.get_local(id_str)
+                if entry is not None:
+                    values[i] = entry["value"]
+                else:
+                    remote.append(i)
+
+            entries = get_many([keys[i] for i in remote])
+            for i, entry in zip(remote, entries):
+                layers.count(entry)
+                if entry is not None and layers.is_fresh(entry):
+                    layers.set_local(keys[i], entry)
+                    values[i] = entry["value"]
+                else:
+                    missing.append(i)
+
+            if len(missing) == 0:
+                return values
+
+            tag_keys = [layers.tag_keys(args_list[i], {}) for i in missing]
+            all_generations = iter(_get_generations([tag_key for keys_of_one in tag_keys for tag_key in keys_of_one]))
+            generations = [[next(all_generations) for _ in keys_of_one] for keys_of_one in tag_keys]
+
+            computed = compute_many([args_list[i] for i in missing])
+            pipe = redis_connection.pipeline(transaction=False)
+            entries = []
+            for i, value, entry_tag_keys, entry_generations in zip(missing, computed, tag_keys, generations):
+                values[i] = value
+                entries.append(store(pipe, keys[i], value, entry_tag_keys, entry_generations))
+            for i, entry, stored in zip(missing, entries, pipe.execute()):
+                if stored:
+                    layers.set_local(keys[i], entry)
 
-                # Calculate the value
-                value = f(*args, **kwargs)
+            return values
 
-                # Set
-                now = time.time()
-                entry = {"time": now, "value": value}
-                redis_connection.set(id_str, pickle.dumps(entry))
-                redis_connection.expire(id_str, ttl)
+        decorated.cache_info = layers.cache_info
+        decorated.cache_key = lambda *args, **kwargs: layers.key(args, kwargs)
+        decorated.get_many = get_many_values
+        decorated.prime_many = layers.prime_many
+        decorated.local_cache = layers.local_cache
+        return decorated
+    return decorator
+
+
+def async_cached(ttl=5*60, stale_ttl=60, lease_ttl=30, local_ttl=None, local_maxsize=128, tags=None):
+    """The asyncio version of cached, which talks to redis without blocking the event loop.
+
+    The decorated function may be a coroutine function, or a plain blocking function which is then run on the database
+    thread pool when its value needs computing. Either way the result must be awaited.
+
+    The decorated function's get_many looks up the values for many sets of positional arguments with a single MGET, and
+    computes all the values which are missing or stale with one call to a given batch function. Its prime_many is the
+    same as cached's, so blocks and is for background threads."""
+    def decorator(f):
+        layers = _CacheLayers(f, ttl, stale_ttl, local_ttl, local_maxsize, tags)
+
+        async def call(func, *args, **kwargs):
+            if asyncio.iscoroutinefunction(func):
+                return await func(*args, **kwargs)
+            return await database.run_sync(func, *args, **kwargs)
+
+        async def store(pipe, id_str, value, tag_keys, generations):
+            entry, data = layers.make_entry(value)
+            await _async_store_script(**layers.store_args(id_str, data, tag_keys, generations), client=pipe)
+            return entry
+
+        async def try_get(id_str):
+            cached_entry = await async_redis_connection.get(id_str)
+
+            if cached_entry is not None:
+                cached_entry = pickle.loads(cached_entry)
+            layers.count(cached_entry)
+
+            return cached_entry
+
+        async def compute(id_str, args, kwargs):
+            tag_keys = layers.tag_keys(args, kwargs)
+            generations = await _async_get_generations(tag_keys)
+
+            # Calculate the value
+            value = await call(f, *args, **kwargs)
+
+            # Set
+            pipe = async_redis_connection.pipeline(transaction=False)
+            entry = await store(pipe, id_str, value, tag_keys, generations)
+            stored, = await pipe.execute()
+            if stored:
+                layers.set_local(id_str, entry)
+
+            return value
+
+        async def refresh(id_str, token, args, kwargs):
+            try:
+                await compute(id_str, args, kwargs)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                await async_release_lease(id_str, token)
+
+        async def wait_for_value(id_str):
+            # Another worker holds the lease, so wait for it to produce the value
+            give_up = time.time() + lease_ttl
+            while time.time() < give_up:
+                await asyncio.sleep(_LEASE_POLL_INTERVAL)
+                entry = await try_get(id_str)
+                if entry is not None:
+                    return entry
+                if not await async_redis_connection.exists(id_str + "-lease"):
+                    break
+            return None
+
+        @functools.wraps(f)
+        async def decorated(*args, **kwargs):
+            id_str = layers.key(args, kwargs)
+
+            entry = layers.get_local(id_str)
+            if entry is not None:
+                return entry["value"]
+
+            entry = await try_get(id_str)
+            if entry is not None:
+                if layers.is_fresh(entry):
+                    layers.set_local(id_str, entry)
+                    return entry["value"]
+
+                # Stale, so serve the old value while one worker refreshes it
+                token = await async_try_acquire_lease(id_str, lease_ttl)
+                if token is not None:
+                    task = asyncio.ensure_future(refresh(id_str, token, args, kwargs))
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+                return entry["value"]
+
+            token = await async_try_acquire_lease(id_str, lease_ttl)
+            if token is None:
+                entry = await wait_for_value(id_str)
+                if entry is not None:
+                    return entry["value"]
+
+                # The worker holding the lease failed or is taking too long, so compute it ourselves
+                return await compute(id_str, args, kwargs)
 
-                # Return
-                return value
+            try:
+                return await compute(id_str, args, kwargs)
             finally:
-                mutex.release()
+                await async_release_lease(id_str, token)
+
+        async def get_many(args_list: List[tuple], compute_many: Callable[[List[tuple]], List[Any]]) -> List[Any]:
+            keys = [layers.key(args, {}) for args in args_list]
+            values: List[Any] = [None] * len(keys)
+            missing = []
+
+            remote = []
+            for i, id_str in enumerate(keys):
+                entry = layers.get_local(id_str)
+                if entry is not None:
+                    values[i] = entry["value"]
+                else:
+                    remote.append(i)
+
+            entries = await async_get_many([keys[i] for i in remote])
+            for i, entry in zip(remote, entries):
+                layers.count(entry)
+                if entry is not None and layers.is_fresh(entry):
+                    layers.set_local(keys[i], entry)
+                    values[i] = entry["value"]
+                else:
+                    missing.append(i)
+
+            if len(missing) == 0:
+                return values
+
+            tag_keys = [layers.tag_keys(args_list[i], {}) for i in missing]
+            all_generations = iter(await _async_get_generations(
+                [tag_key for keys_of_one in tag_keys for tag_key in keys_of_one]))
+            generations = [[next(all_generations) for _ in keys_of_one] for keys_of_one in tag_keys]
+
+            computed = await call(compute_many, [args_list[i] for i in missing])
+            pipe = async_redis_connection.pipeline(transaction=False)
+            entries = []
+            for i, value, entry_tag_keys, entry_generations in zip(missing, computed, tag_keys, generations):
+                values[i] = value
+                entries.append(await store(pipe, keys[i], value, entry_tag_keys, entry_generations))
+            for i, entry, stored in zip(missing, entries, await pipe.execute()):
+                if stored:
+                    layers.set_local(keys[i], entry)
+
+            return values
+
+        decorated.cache_info = layers.cache_info
+        decorated.cache_key = lambda *args, **kwargs: layers.key(args, kwargs)
+        decorated.get_many = get_many
+        decorated.prime_many = layers.prime_many
+        decorated.local_cache = layers.local_cache
         return decorated
     return decorator
@@ -14,3 +14,29 @@ ACCESS_TOKEN_EXPIRE_MINUTES = config_file.get("front_end.access_token_expire_min
 ACCESS_TOKEN_ALGORITHM = config_file.get("front_end.access_token_algorithm")
 
 ADMINS = {str(account) for account in config_file.get("admin_emails")}
+
+
+def _get_or_default(key, default):
+    value = config_file.get(key)
+    return default if value is None else value
+
+
+# Each gunicorn worker has its own pool, so the database must allow workers * (size + max overflow) connections
+DB_POOL_SIZE = int(_get_or_default("db_pool.size", 10))
+DB_POOL_MAX_OVERFLOW = int(_get_or_default("db_pool.max_overflow", 10))
+DB_POOL_TIMEOUT = float(_get_or_default("db_pool.timeout_seconds", 30))
+DB_POOL_RECYCLE = int(_get_or_default("db_pool.recycle_seconds", 30 * 60))
+
+# How many git clones each worker runs at once, so a rush of submissions can't use up all of the CPU and disk
+CLONE_CONCURRENCY = int(_get_or_default("clone_concurrency", 2))
+
+# The disk space kept for mirrors of submitted repositories, after which the least recently used are deleted
+GIT_MIRROR_CACHE_BYTES = int(_get_or_default("git_mirror_cache_bytes", 2 * 1024 ** 3))
+
+# Submission archives can be stored compressed with "gzip", once everything reading them expects <hash>.tar.gz
+ARCHIVE_COMPRESSION = _get_or_default("archive_compression", None)
+ARCHIVE_COMPRESSION_LEVEL = int(_get_or_default("archive_compression_level", 6))
+
+# Messages added since the localisation config was first written fall back to English
+UNTESTED_SUBMISSION_MESSAGE = _get_or_default("localisation.untested_submission", "Submission has not been tested")
+INVALID_ARCHIVE_MESSAGE = _get_or_default("localisation.invalid_archive", "The submission must be a tar archive")
@@ -0,0 +1,132 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import AsyncIterator
+
+from cuwais.config import config_file
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+from app.config import DEBUG, DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+
+# Checkouts which wait at least this long are logged, as they are what makes the slowest requests slow
+SLOW_CHECKOUT_SECONDS = 0.1
+_RECENT_CHECKOUTS = 1000
+
+
+class _CheckoutStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.slow_checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent = deque(maxlen=_RECENT_CHECKOUTS)
+        self._mutex = Lock()
+
+    def record(self, wait: float):
+        with self._mutex:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._recent.append(wait)
+            if wait >= SLOW_CHECKOUT_SECONDS:
+                self.slow_checkouts += 1
+
+        if wait >= SLOW_CHECKOUT_SECONDS:
+            logging.warning(f"Waited {wait:.3f}s for a database connection")
+
+    def info(self) -> dict:
+        with self._mutex:
+            recent = sorted(self._recent)
+
+        def percentile(p):
+            return recent[min(int(len(recent) * p), len(recent) - 1)] if len(recent) != 0 else 0.0
+
+        return {"checkouts": self.checkouts,
+                "slow_checkouts": self.slow_checkouts,
+                "mean_wait": self.total_wait / self.checkouts if self.checkouts != 0 else 0.0,
+                "max_wait": self.max_wait,
+                "recent_p50_wait": percentile(0.5),
+                "recent_p99_wait": percentile(0.99)}
+
+
+_checkout_stats = _CheckoutStats()
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool which records how long each checkout waits for a connection"""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _checkout_stats.record(time.perf_counter() - start)
+
+
+engine = create_engine(config_file.get("db_connection"), echo=DEBUG, future=True, poolclass=TimedQueuePool,
+                       pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                       pool_recycle=DB_POOL_RECYCLE)
+
+# More threads than connections would only queue for a connection
+DB_THREADS = DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW
+
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+def create_session() -> Session:
+    return Session(engine)
+
+
+async def get_db_session() -> AsyncIterator[Session]:
+    """A FastAPI dependency giving one session for the whole request, shared by authentication and the endpoint.
+    run_sync ends its transaction after every unit of work, so its objects aren't expired by commits.
+    It is async so that FastAPI doesn't run it on its own thread pool; only closing may touch the database"""
+    db_session = Session(engine, expire_on_commit=False)
+    try:
+        yield db_session
+    finally:
+        await run_sync(db_session.close)
+
+
+def get_pool_stats() -> dict:
+    return {"size": engine.pool.size(),
+            "checked_out": engine.pool.checkedout(),
+            "overflow": engine.pool.overflow(),
+            **_checkout_stats.info()}
+
+
+def _run_releasing_sessions(f, *args, **kwargs):
+    sessions = [arg for arg in [*args, *kwargs.values()] if isinstance(arg, Session)]
+    try:
+        result = f(*args, **kwargs)
+    except BaseException:
+        for db_session in sessions:
+            db_session.rollback()
+        raise
+
+    for db_session in sessions:
+        db_session.commit()
+    return result
+
+
+async def run_sync(f, *args, **kwargs):
+    """Runs a blocking function on the database thread pool, so that it doesn't hold up the event loop.
+    The transaction of any session passed to it is ended afterwards, so that the session's connection goes back to the
+    pool rather than being held while the request awaits something else, which may itself need a connection"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_run_releasing_sessions, f, *args, **kwargs))
+
+
+async def run_in_session(f, *args, **kwargs):
+    """Calls f(db_session, *args, **kwargs) with a new session on the database thread pool.
+    The session is closed afterwards, so f must commit anything it changes"""
+    def in_session():
+        with create_session() as db_session:
+            return f(db_session, *args, **kwargs)
+
+    return await run_sync(in_session)
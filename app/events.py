@@ -0,0 +1,77 @@
+import json
+import logging
+import time
+from threading import Thread
+
+from app import caching, database, queries, leaderboard
+from app.caching import try_acquire_lease, release_lease
+
+MATCH_RESULTS_CHANNEL = "match-results"
+
+# How often one worker checks the database for matches whose result messages never arrived
+CATCH_UP_INTERVAL = 30
+_CATCH_UP_LEASE_KEY = "match-results-catch-up"
+
+_catch_up_thread = None
+
+
+def _invalidate_match(db_session, match_id: int):
+    participants = queries.get_match_participants(db_session, match_id)
+    newly_healthy = queries.get_first_healthy_participants(db_session, match_id)
+
+    # A submission's first healthy result may make it its user's current submission
+    caching.invalidate("scoreboard",
+                       *[f"submission:{submission_id}" for submission_id, _ in participants],
+                       *[f"user:{user_id}" for _, user_id in newly_healthy])
+    queries.record_crash_summaries(db_session, match_id)
+
+
+def on_match_result(message):
+    """Handles a new match result, published by the runner as a JSON object {"match_id": int}"""
+    try:
+        match_id = int(json.loads(message["data"])["match_id"])
+    except (ValueError, KeyError, TypeError):
+        logging.warning(f"Invalid match result message: {message}")
+        return
+
+    # Every worker hears every message, but only the first to apply the match needs to invalidate
+    with database.create_session() as db_session:
+        if leaderboard.apply_match(db_session, match_id):
+            _invalidate_match(db_session, match_id)
+
+
+def catch_up():
+    """Applies any matches which were missed, e.g. because no message was published or handling it failed"""
+    token = try_acquire_lease(_CATCH_UP_LEASE_KEY, CATCH_UP_INTERVAL)
+    if token is None:
+        return
+
+    try:
+        with database.create_session() as db_session:
+            count = leaderboard.catch_up(db_session,
+                                         lambda match_id: _invalidate_match(db_session, match_id))
+        if count != 0:
+            logging.info(f"Caught up on {count} missed match results")
+    finally:
+        release_lease(_CATCH_UP_LEASE_KEY, token)
+
+
+def _catch_up_forever():
+    while True:
+        try:
+            catch_up()
+        except Exception:
+            logging.exception("Failed to catch up on match results")
+        time.sleep(CATCH_UP_INTERVAL)
+
+
+def start_listening():
+    global _catch_up_thread
+
+    caching.subscribe(MATCH_RESULTS_CHANNEL, on_match_result)
+    leaderboard.on_rebuild_applied(_invalidate_match)
+    caching.start_subscriptions()
+
+    if _catch_up_thread is None:
+        _catch_up_thread = Thread(target=_catch_up_forever, daemon=True)
+        _catch_up_thread.start()
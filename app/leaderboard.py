@@ -0,0 +1,380 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple, Dict, Iterable, Callable
+
+from cuwais.common import Outcome
+from cuwais.database import User, Submission, Result, Match
+from redis import WatchError
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app import database
+from app.caching import redis_connection, async_redis_connection, try_acquire_lease, release_lease
+
+SCORES_KEY = "leaderboard-scores"
+BUILT_KEY = "leaderboard-built"
+OUTCOMES_KEY_PREFIX = "leaderboard-outcomes-"
+OUTCOME_WINDOW = timedelta(hours=24)
+OUTCOME_NAMES = {Outcome.Win: "wins", Outcome.Loss: "losses", Outcome.Draw: "draws"}
+
+# Every match up to the watermark is counted in the leaderboard, as are the applied matches after it
+WATERMARK_KEY = "leaderboard-watermark"
+APPLIED_KEY = "leaderboard-applied-matches"
+# Match ids are handed out before their results are committed, so the watermark only passes matches this old
+MATCH_SETTLE_TIME = timedelta(minutes=10)
+
+# Users without any results are kept at the bottom of the leaderboard
+UNRANKED = float("-inf")
+
+_REBUILD_LEASE_TTL = 5 * 60
+_REBUILD_WAIT = 30
+_REBUILD_POLL_INTERVAL = 0.1
+
+# Called for each match a rebuild applies after loading, as catch_up's on_applied is
+_rebuild_handlers: List[Callable[[Session, int], None]] = []
+
+# Adding to an unranked user starts them from 0
+_INCREMENT_SCORE_LUA = """
+local score = redis.call("zscore", KEYS[1], ARGV[1])
+if (not score) or score == "-inf" then
+    score = 0
+end
+return redis.call("zadd", KEYS[1], tonumber(score) + tonumber(ARGV[2]), ARGV[1])
+"""
+_increment_score_script = redis_connection.register_script(_INCREMENT_SCORE_LUA)
+
+LeaderboardEntry = Tuple[int, Optional[float], Dict[str, int]]
+
+
+def _outcomes_key(user_id: int) -> str:
+    return OUTCOMES_KEY_PREFIX + str(user_id)
+
+
+def _hour(date: datetime) -> int:
+    return int(date.timestamp()) // 3600 * 3600
+
+
+def _outcome_field(outcome: Outcome, hour: int) -> str:
+    return f"{OUTCOME_NAMES[outcome]}-{hour}"
+
+
+def _get_watermark(client) -> int:
+    watermark = client.get(WATERMARK_KEY)
+    return 0 if watermark is None else int(watermark)
+
+
+def _get_applied(client, watermark: int) -> List[int]:
+    return [int(match_id) for match_id in client.zrangebyscore(APPLIED_KEY, f"({watermark}", "+inf")]
+
+
+def _load(db_session: Session, counted, user_ids: Optional[Iterable[int]] = None) \
+        -> Tuple[Dict[int, Optional[float]], Dict[int, Dict[str, int]]]:
+    """Loads the total score of every user, and their counted outcomes in each hour of the outcome window,
+    from the results matching the counted condition"""
+    scores_query = db_session.query(
+        User.id,
+        func.sum(Result.points_delta)
+    ).outerjoin(User.submissions) \
+        .outerjoin(Submission.results.and_(counted)) \
+        .group_by(User.id)
+
+    since = datetime.now() - OUTCOME_WINDOW
+    hour = func.date_trunc('hour', Match.match_date)
+    outcomes_query = db_session.query(
+        Submission.user_id,
+        hour,
+        Result.outcome,
+        func.count(Result.id)
+    ).join(Submission.results) \
+        .join(Result.match) \
+        .filter(Result.healthy == True, Result.points_delta != 0, Match.match_date > since, counted) \
+        .group_by(Submission.user_id, hour, Result.outcome)
+
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        scores_query = scores_query.filter(User.id.in_(user_ids))
+        outcomes_query = outcomes_query.filter(Submission.user_id.in_(user_ids))
+
+    scores = {user_id: score for user_id, score in scores_query.all()}
+    outcomes = {user_id: {} for user_id in scores}
+    for user_id, bucket, outcome, count in outcomes_query.all():
+        if user_id in outcomes:
+            outcomes[user_id][_outcome_field(Outcome(outcome), _hour(bucket))] = count
+
+    return scores, outcomes
+
+
+def _write_users(pipe, scores: Dict[int, Optional[float]], outcomes: Dict[int, Dict[str, int]], scores_key: str):
+    if len(scores) != 0:
+        pipe.zadd(scores_key, {str(user_id): (UNRANKED if score is None else score)
+                               for user_id, score in scores.items()})
+    for user_id, fields in outcomes.items():
+        pipe.delete(_outcomes_key(user_id))
+        if len(fields) != 0:
+            pipe.hset(_outcomes_key(user_id), mapping=fields)
+
+
+def _load_settled(db_session: Session) -> Tuple[int, Dict[int, Optional[float]], Dict[int, Dict[str, int]]]:
+    """Loads the whole leaderboard from the settled matches, returning the last of them as the watermark"""
+    watermark = db_session.query(func.max(Match.id)) \
+        .filter(Match.match_date < datetime.now() - MATCH_SETTLE_TIME) \
+        .scalar() or 0
+    scores, outcomes = _load(db_session, Result.match_id <= watermark)
+    return watermark, scores, outcomes
+
+
+def on_rebuild_applied(handler: Callable[[Session, int], None]):
+    """Registers a handler for the matches a rebuild applies after loading, e.g. to invalidate what they change"""
+    if handler not in _rebuild_handlers:
+        _rebuild_handlers.append(handler)
+
+
+def _call_rebuild_handlers(db_session: Session, match_id: int):
+    for handler in _rebuild_handlers:
+        handler(db_session, match_id)
+
+
+def rebuild():
+    """Recomputes the whole leaderboard from the database. Only one worker rebuilds at a time"""
+    token = try_acquire_lease(SCORES_KEY, _REBUILD_LEASE_TTL)
+    if token is None:
+        return
+
+    try:
+        with database.create_session() as db_session:
+            watermark, scores, outcomes = _load_settled(db_session)
+
+        old_user_ids = [int(user_id) for user_id in redis_connection.zrange(SCORES_KEY, 0, -1)]
+
+        # Swap everything over in one transaction, so readers never see a half built leaderboard
+        new_scores_key = SCORES_KEY + "-rebuilding"
+        pipe = redis_connection.pipeline(transaction=True)
+        pipe.delete(new_scores_key)
+        for user_id in old_user_ids:
+            pipe.delete(_outcomes_key(user_id))
+        _write_users(pipe, scores, outcomes, new_scores_key)
+        if len(scores) != 0:
+            pipe.rename(new_scores_key, SCORES_KEY)
+        else:
+            pipe.delete(SCORES_KEY)
+        pipe.set(WATERMARK_KEY, watermark)
+        pipe.delete(APPLIED_KEY)
+        pipe.set(BUILT_KEY, 1)
+        pipe.execute()
+
+        # Replay the matches after the watermark, including any recorded on the old leaderboard while loading
+        with database.create_session() as db_session:
+            catch_up(db_session, lambda match_id: _call_rebuild_handlers(db_session, match_id))
+
+        logging.info(f"Rebuilt leaderboard with {len(scores)} users")
+    finally:
+        release_lease(SCORES_KEY, token)
+
+
+def refresh_users(db_session: Session, user_ids: Iterable[int]):
+    """Recomputes the leaderboard entries of some users, e.g. after their results are deleted"""
+    user_ids = list(user_ids)
+
+    # Only count the matches the rest of the leaderboard counts, retrying if that changes while loading
+    with redis_connection.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(WATERMARK_KEY, APPLIED_KEY)
+                watermark = _get_watermark(pipe)
+                applied = _get_applied(pipe, watermark)
+                scores, outcomes = _load(db_session, or_(Result.match_id <= watermark, Result.match_id.in_(applied)),
+                                         user_ids)
+
+                pipe.multi()
+                for user_id in user_ids:
+                    if user_id not in scores:
+                        pipe.zrem(SCORES_KEY, str(user_id))
+                        pipe.delete(_outcomes_key(user_id))
+                _write_users(pipe, scores, outcomes, SCORES_KEY)
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+
+def add_user(user_id: int):
+    redis_connection.zadd(SCORES_KEY, {str(user_id): UNRANKED}, nx=True)
+
+
+def remove_user(user_id: int):
+    pipe = redis_connection.pipeline(transaction=True)
+    pipe.zrem(SCORES_KEY, str(user_id))
+    pipe.delete(_outcomes_key(user_id))
+    pipe.execute()
+
+
+def _query_match_results(db_session: Session, match_id: int):
+    return db_session.query(
+        Submission.user_id,
+        Result.points_delta,
+        Result.outcome,
+        Result.healthy,
+        Match.match_date
+    ).join(Submission.results) \
+        .join(Result.match) \
+        .filter(Match.id == match_id) \
+        .all()
+
+
+def apply_match(db_session: Session, match_id: int) -> bool:
+    """Adds the results of a match to the leaderboard, unless they already have been. Returns whether they were added.
+    The match is marked as applied in the same transaction as its results, so if this fails catch_up will retry it"""
+    results = _query_match_results(db_session, match_id)
+
+    with redis_connection.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(WATERMARK_KEY, APPLIED_KEY)
+                if match_id <= _get_watermark(pipe) or pipe.zscore(APPLIED_KEY, str(match_id)) is not None:
+                    return False
+
+                pipe.multi()
+                for user_id, points_delta, outcome, healthy, match_date in results:
+                    _increment_score_script(keys=[SCORES_KEY], args=[str(user_id), points_delta], client=pipe)
+                    if healthy and points_delta != 0:
+                        pipe.hincrby(_outcomes_key(user_id), _outcome_field(Outcome(outcome), _hour(match_date)), 1)
+                pipe.zadd(APPLIED_KEY, {str(match_id): match_id})
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
+def _advance_watermark(match_ids: List[int]):
+    """Moves the watermark up to the last of the given matches, if they are all still applied"""
+    with redis_connection.pipeline(transaction=True) as pipe:
+        try:
+            pipe.watch(WATERMARK_KEY, APPLIED_KEY)
+            watermark = _get_watermark(pipe)
+            if match_ids[-1] <= watermark:
+                return
+            applied = set(_get_applied(pipe, watermark))
+            if any(match_id > watermark and match_id not in applied for match_id in match_ids):
+                # The leaderboard was rebuilt underneath us
+                return
+
+            pipe.multi()
+            pipe.set(WATERMARK_KEY, match_ids[-1])
+            pipe.zremrangebyscore(APPLIED_KEY, "-inf", match_ids[-1])
+            pipe.execute()
+        except WatchError:
+            # Someone else moved it, and the next catch up will try again
+            pass
+
+
+def catch_up(db_session: Session, on_applied: Optional[Callable[[int], None]] = None) -> int:
+    """Applies every match after the watermark which hasn't been yet, e.g. because its result message was lost,
+    then moves the watermark past the settled matches. Returns how many matches were applied"""
+    watermark = _get_watermark(redis_connection)
+    matches = db_session.query(Match.id, Match.match_date) \
+        .filter(Match.id > watermark) \
+        .order_by(Match.id) \
+        .all()
+    if len(matches) == 0:
+        return 0
+
+    applied = set(_get_applied(redis_connection, watermark))
+    count = 0
+    for match_id, _ in matches:
+        if match_id not in applied and apply_match(db_session, match_id):
+            count += 1
+            if on_applied is not None:
+                on_applied(match_id)
+
+    settled_before = datetime.now() - MATCH_SETTLE_TIME
+    settled = [i for i, (_, match_date) in enumerate(matches) if match_date < settled_before]
+    if len(settled) != 0:
+        _advance_watermark([match_id for match_id, _ in matches[:settled[-1] + 1]])
+
+    return count
+
+
+async def ensure_built():
+    if await async_redis_connection.exists(BUILT_KEY):
+        return
+
+    await database.run_sync(rebuild)
+
+    # Another worker may have been the one rebuilding, so wait for it to finish
+    for _ in range(int(_REBUILD_WAIT / _REBUILD_POLL_INTERVAL)):
+        if await async_redis_connection.exists(BUILT_KEY):
+            return
+        await asyncio.sleep(_REBUILD_POLL_INTERVAL)
+
+
+def _parse_entry(user_id: bytes, score: float) -> Tuple[int, Optional[float]]:
+    return int(user_id), (None if score == UNRANKED else score)
+
+
+async def get_outcomes(user_ids: List[int]) -> List[Dict[str, int]]:
+    """Gets the wins, losses and draws of each user within the outcome window, to the nearest hour"""
+    pipe = async_redis_connection.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hgetall(_outcomes_key(user_id))
+    all_fields = await pipe.execute()
+
+    since = (datetime.now() - OUTCOME_WINDOW).timestamp()
+    outcomes = []
+    expired = []
+    for user_id, fields in zip(user_ids, all_fields):
+        counts = {name: 0 for name in OUTCOME_NAMES.values()}
+        for field, count in fields.items():
+            name, hour = field.decode().split("-")
+            if int(hour) + 3600 > since:
+                counts[name] += int(count)
+            else:
+                expired.append((user_id, field))
+        outcomes.append(counts)
+
+    # Clear out hours which have left the window
+    if len(expired) != 0:
+        pipe = async_redis_connection.pipeline(transaction=False)
+        for user_id, field in expired:
+            pipe.hdel(_outcomes_key(user_id), field)
+        await pipe.execute()
+
+    return outcomes
+
+
+async def get_entries(start: int = 0, stop: int = -1) -> List[LeaderboardEntry]:
+    """Gets the (user id, score, outcomes) of the users ranked from start to stop inclusive, best first.
+    Scores are the sum of a user's points deltas, or None if they have no results"""
+    await ensure_built()
+
+    ranked = await async_redis_connection.zrevrange(SCORES_KEY, start, stop, withscores=True)
+    ranked = [_parse_entry(user_id, score) for user_id, score in ranked]
+    outcomes = await get_outcomes([user_id for user_id, _ in ranked])
+
+    return [(user_id, score, user_outcomes) for (user_id, score), user_outcomes in zip(ranked, outcomes)]
+
+
+async def get_rank(user_id: int) -> Optional[int]:
+    """Gets the 0-indexed position of a user on the leaderboard, or None if they aren't on it"""
+    await ensure_built()
+
+    return await async_redis_connection.zrevrank(SCORES_KEY, str(user_id))
+
+
+async def get_size() -> int:
+    await ensure_built()
+
+    return await async_redis_connection.zcard(SCORES_KEY)
+
+
+async def get_scores(user_ids: List[int]) -> Dict[int, Optional[float]]:
+    """Gets the current total score of each user, or None if they have no results"""
+    await ensure_built()
+
+    pipe = async_redis_connection.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zscore(SCORES_KEY, str(user_id))
+    scores = await pipe.execute()
+
+    return {user_id: (None if score is None or score == UNRANKED else score)
+            for user_id, score in zip(user_ids, scores)}
@@ -1,12 +1,15 @@
+import json
 import logging
 import os
+import re
+import time
+from threading import Lock, Thread
+from typing import Dict, Optional, Tuple
 
 from cuwais.config import config_file
 from cuwais.database import User
 from google.auth import exceptions
-from google.oauth2 import id_token
-import google.auth.transport.requests
-import cachecontrol
+import google.auth.jwt
 import requests
 from sqlalchemy import select
 
@@ -17,16 +20,117 @@ from app.config import ADMINS
 from app.queries import generate_nickname
 
 session = requests.session()
-cached_session = cachecontrol.CacheControl(session)
 _client_id = config_file.get("google_client_id")
 
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = {"accounts.google.com", "https://accounts.google.com"}
+
+# Refresh the certs this long before Google says they expire, and retry this often if fetching them fails
+_CERTS_REFRESH_MARGIN = 10 * 60
+_CERTS_RETRY_INTERVAL = 60
+_CERTS_DEFAULT_MAX_AGE = 60 * 60
+
+_certs: Dict[str, str] = {}
+_certs_fetched = 0.0
+_certs_attempted = 0.0
+_certs_expiry = 0.0
+# Held for the whole of a fetch, so that only one is ever in flight
+_certs_mutex = Lock()
+_certs_refresher: Optional[Thread] = None
+
+
+def _fetch_certs() -> Tuple[Dict[str, str], float]:
+    """Gets Google's current signing certs by key id, and how many seconds they can be used for"""
+    response = session.get(GOOGLE_CERTS_URL, timeout=10)
+    response.raise_for_status()
+
+    max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return response.json(), _CERTS_DEFAULT_MAX_AGE if max_age is None else int(max_age.group(1))
+
+
+def _set_certs(certs: Dict[str, str], max_age: float):
+    # Must hold _certs_mutex
+    global _certs, _certs_fetched, _certs_attempted, _certs_expiry
+    _certs = certs
+    _certs_fetched = _certs_attempted = time.time()
+    _certs_expiry = _certs_fetched + max_age
+
+
+def refresh_certs(attempted_before: Optional[float] = None) -> bool:
+    """Fetches Google's certs, returning whether it succeeded.
+    If attempted_before is given and another fetch was attempted since then, e.g. while waiting for the one in flight,
+    then the result of that fetch is returned instead of fetching again"""
+    global _certs_attempted
+    with _certs_mutex:
+        if attempted_before is not None and _certs_attempted != attempted_before:
+            return _certs_fetched == _certs_attempted
+
+        try:
+            certs, max_age = _fetch_certs()
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Could not fetch Google certs: {e}")
+            _certs_attempted = time.time()
+            return False
+
+        _set_certs(certs, max_age)
+        return True
+
+
+def load_certs(path: str):
+    """Seeds the certs from a JSON file in the same format as Google's, e.g. so tests can sign their own tokens"""
+    with open(path) as certs_file:
+        certs = json.load(certs_file)
+    with _certs_mutex:
+        _set_certs(certs, _CERTS_DEFAULT_MAX_AGE)
+
+
+def _refresh_certs_forever():
+    while True:
+        if refresh_certs():
+            wait = _certs_expiry - time.time() - _CERTS_REFRESH_MARGIN
+        else:
+            wait = _CERTS_RETRY_INTERVAL
+        time.sleep(max(wait, _CERTS_RETRY_INTERVAL))
+
+
+def start_certs_refresh():
+    """Loads Google's certs and keeps them fresh on a background thread, so that logins never wait to fetch them"""
+    global _certs_refresher
+    if _certs_refresher is not None:
+        return
+
+    certs_path = config_file.get("google_certs_file")
+    if certs_path is not None:
+        load_certs(certs_path)
+        return
+
+    _certs_refresher = Thread(target=_refresh_certs_forever, daemon=True)
+    _certs_refresher.start()
+
+
+def _verify_token(token) -> dict:
+    """Checks a Google ID token against the certs held locally"""
+    try:
+        id_info = google.auth.jwt.decode(token, certs=_certs, audience=_client_id)
+    except ValueError:
+        # Google may have started signing with a new key which we haven't seen yet, but don't let bad tokens make us
+        # fetch the certs more than once every retry interval. Concurrent logins share a single fetch
+        key_id = google.auth.jwt.decode_header(token).get("kid")
+        attempted = _certs_attempted
+        if key_id in _certs or time.time() - attempted < _CERTS_RETRY_INTERVAL or not refresh_certs(attempted):
+            raise
+        id_info = google.auth.jwt.decode(token, certs=_certs, audience=_client_id)
+
+    if id_info["iss"] not in GOOGLE_ISSUERS:
+        raise exceptions.GoogleAuthError(f"Wrong issuer: {id_info['iss']}")
+
+    return id_info
+
 
 def get_user_from_google_token(db_session, token) -> User:
     id_info = None
     try:
-        # Specify the CLIENT_ID of the app that accesses the backend:
-        google_request = google.auth.transport.requests.Request(session=cached_session)
-        id_info = id_token.verify_oauth2_token(token, google_request, _client_id)
+        id_info = _verify_token(token)
 
         if not str(id_info['iss']).endswith('accounts.google.com'):
             raise ValueError('Wrong issuer.')
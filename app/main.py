@@ -1,6 +1,3 @@
-from gevent import monkey
-monkey.patch_all()
-
 from views import app
 import cuwais.database
 
@@ -0,0 +1,70 @@
+"""Rewrites every stored submission archive in the configured archive_compression, several at a time.
+Archives made before the blob store existed are moved into it as well, so that duplicates are only stored once,
+and archives made before manifests are given them.
+
+    python -m app.migrate_archives --workers 8
+
+Submissions can keep being made and deleted while it runs."""
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from app import repo
+
+
+def get_archive_hashes() -> Dict[str, str]:
+    """Gets the file name of every submission archive, by the submission's hash"""
+    suffixes = sorted((".tar" + suffix for suffix in repo.ARCHIVE_SUFFIXES.values()), key=len, reverse=True)
+    hashes = {}
+    for name in os.listdir(repo.GIT_BASE_DIR):
+        for suffix in suffixes:
+            if name.endswith(suffix):
+                hashes[name[:-len(suffix)]] = name
+                break
+    return hashes
+
+
+def get_archives_size_bytes() -> int:
+    """Gets the disk space used by archives, counting files with many links once"""
+    inodes = {}
+    for dir_path, _, filenames in os.walk(repo.GIT_BASE_DIR):
+        if dir_path.startswith(str(repo.MIRROR_BASE_DIR)):
+            continue
+        for f in filenames:
+            stat = os.stat(os.path.join(dir_path, f))
+            inodes[stat.st_ino] = stat.st_size
+    return sum(inodes.values())
+
+
+def migrate_archive(files_hash: str) -> str:
+    try:
+        return "rewritten" if repo.restore_archive(files_hash) else "unchanged"
+    except FileNotFoundError:
+        # Deleted since it was listed
+        return "deleted"
+    except Exception as e:
+        logging.exception(e)
+        return "failed"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    start_size = get_archives_size_bytes()
+    hashes = list(get_archive_hashes())
+
+    # Compression and hashing release the GIL, so threads run them in parallel
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        outcomes = list(executor.map(migrate_archive, hashes))
+
+    for outcome in ["rewritten", "unchanged", "deleted", "failed"]:
+        print(f"{outcome}: {outcomes.count(outcome)}")
+    print(f"Archives went from {start_size} bytes to {get_archives_size_bytes()} bytes")
+
+
+if __name__ == "__main__":
+    main()
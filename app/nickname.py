@@ -1,5 +1,18 @@
 import random
 
+from cuwais.database import User
+from sqlalchemy import event
+from sqlalchemy.orm import Session, SessionTransaction
+
+from app.caching import redis_connection
+
+TAKEN_KEY = "nicknames-taken"
+LOADED_KEY = "nicknames-loaded"
+
+# Names are picked at random from a space at least twice as big as the number taken, so a pick is free at least half
+# of the time however many users there are
+_MAX_PICKS = 32
+
 positive_adjectives = ["Acclaimed", "Accomplished", "Accurate", "Admirable", "Adorable", "Adored", "Advanced",
                        "Adventurous", "Affectionate", "Agile", "Agreeable", "Altruistic", "Amazing", "Ambitious",
                        "Ample", "Amusing", "Angelic", "Appropriate", "Astonishing", "Attentive", "Attractive",
@@ -49,7 +62,83 @@ animals = ["Hedgehog", "Crab", "Eagle", "Reindeer", "Mouse", "Robin", "Leopard",
            "Dolphin", "Otter", "Flamingo", "Ox", "Goose", "Chicken", "Swallow", "Hawk", "Swan"]
 
 
-def get_new_name():
-    a = positive_adjectives[random.randint(0, len(positive_adjectives) - 1)]
-    b = animals[random.randint(0, len(animals) - 1)]
-    return f"{a} {b}".title()
+_base_names = sorted({f"{a} {b}".title() for a in positive_adjectives for b in animals})
+BASE_NAME_COUNT = len(_base_names)
+
+
+def get_name(index: int) -> str:
+    """Gets the name with the given index. Every base name is used once before any are reused with a number after them,
+    so there are as many names as are needed"""
+    repeat, i = divmod(index, BASE_NAME_COUNT)
+    name = _base_names[i]
+    return name if repeat == 0 else f"{name} {repeat + 1}"
+
+
+def get_random_index(name_count: int) -> int:
+    return random.randrange(name_count)
+
+
+def _ensure_loaded(db_session: Session):
+    if redis_connection.exists(LOADED_KEY):
+        return
+
+    # Loading is idempotent, so it doesn't matter if several workers do it at once
+    taken = [name for name, in db_session.query(User.nickname).all()]
+    pipe = redis_connection.pipeline(transaction=True)
+    if len(taken) != 0:
+        pipe.sadd(TAKEN_KEY, *taken)
+    pipe.set(LOADED_KEY, 1)
+    pipe.execute()
+
+
+def claim_name(name: str) -> bool:
+    """Marks a name as taken, returning whether it was free. Only one caller can ever claim any given name"""
+    return redis_connection.sadd(TAKEN_KEY, name) == 1
+
+
+def release_name(name: str):
+    redis_connection.srem(TAKEN_KEY, name)
+
+
+def claim_name_on_commit(db_session: Session, name: str) -> bool:
+    """Claims a name for a user being added in the session, releasing it again unless the session commits"""
+    if not claim_name(name):
+        return False
+    # The name is released when the transaction ends, so there has to be one
+    if not db_session.in_transaction():
+        db_session.begin()
+    db_session.info.setdefault("claimed_nicknames", set()).add(name)
+    return True
+
+
+@event.listens_for(Session, "after_commit")
+def _keep_committed_names(db_session: Session):
+    db_session.info.pop("claimed_nicknames", None)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _release_uncommitted_names(db_session: Session, transaction: SessionTransaction):
+    # Closing a session doesn't count as rolling it back, so this catches both
+    if transaction.parent is not None:
+        return
+    names = db_session.info.pop("claimed_nicknames", None)
+    if names:
+        redis_connection.srem(TAKEN_KEY, *names)
+
+
+def claim_new_name(db_session: Session) -> str:
+    """Picks a random name which no user has, and claims it for a user being added in the session"""
+    _ensure_loaded(db_session)
+
+    name_count = BASE_NAME_COUNT
+    while True:
+        while redis_connection.scard(TAKEN_KEY) * 2 >= name_count:
+            name_count += BASE_NAME_COUNT
+
+        for _ in range(_MAX_PICKS):
+            name = get_name(get_random_index(name_count))
+            if claim_name_on_commit(db_session, name):
+                return name
+
+        # Very unlucky, or other workers are claiming names quickly, so look in a bigger space
+        name_count += BASE_NAME_COUNT
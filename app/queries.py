@@ -1,174 +1,284 @@
-import hashlib
 import io
 import json
-import logging
-import tarfile
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 from typing import Optional, List, Tuple, Dict, Any, Union
 
-import cuwais
 from cuwais.common import Outcome
 from cuwais.config import config_file
 from cuwais.database import User, Submission, Result, Match
 from pydantic import BaseModel
 from sqlalchemy import select, func, and_
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, make_transient_to_detached
 
-from app import repo, nickname
-from app.caching import cached
-from app.repo import get_repo_path, AlreadyExistsException, RepoTooBigException
+from app import repo, nickname, database, leaderboard, score_history
+from app.caching import cached, async_cached, invalidate_on_commit
 
 
-def get_user(user_id: Union[str, int]) -> Optional[User]:
+@async_cached(ttl=5*60, local_ttl=30, local_maxsize=1024, tags=lambda user_id: [f"user:{user_id}"])
+def _get_user_snapshot(user_id: int) -> Optional[dict]:
+    with database.create_session() as db_session:
+        user = db_session.query(User).get(user_id)
+
+        if user is None:
+            return None
+
+        return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+
+async def get_user(user_id: Union[str, int]) -> Optional[User]:
+    """Gets a detached copy of a user, from a short lived snapshot of their row. Use attach_user to change it"""
     if user_id is None:
         return None
 
-    user_id = int(user_id)
+    snapshot = await _get_user_snapshot(int(user_id))
 
-    with cuwais.database.create_session() as db_session:
-        return db_session.query(User).get(user_id)
+    if snapshot is None:
+        return None
 
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return user
 
-def generate_nickname(db_session: Session):
-    tried = {}
-    for i in range(1000):
-        nick = nickname.get_new_name()
-        if nick in tried:
-            continue
-        if db_session.query(User).filter(User.nickname == nick).first() is None:
-            return nick
-        tried += nick
-    return "[FAILED TO GENERATE NICKNAME]"
 
+def attach_user(db_session: Session, user: User) -> User:
+    """Gets a user from get_user into a session without loading it from the database again"""
+    return db_session.merge(user, load=False)
 
-def set_user_name_visible(db_session: Session, user: User, visible: bool) -> None:
-    db_session.query(User).get(user.id).display_real_name = visible
 
+def get_public_users(db_session: Session, user_ids) -> Dict[int, dict]:
+    """Gets the public dicts of many users with a single query, omitting any users which no longer exist"""
+    user_ids = set(user_ids)
+    if len(user_ids) == 0:
+        return {}
 
-def make_scoreboard_entry(user: User, score: Optional[int], init: int, outcomes: dict):
-    return {"user_id": user.id,
-            "score": 0 if score is None else (init + score),
-            "score_text": ("" if score is None else "%.0f" % (init + score)),
-            "is_bot": user.is_bot,
-            "outcomes": outcomes}
+    users = db_session.query(User).filter(User.id.in_(user_ids)).all()
 
+    return {user.id: user.to_public_dict() for user in users}
 
-@cached(ttl=300)
-def get_scoreboard_data():
-    with cuwais.database.create_session() as db_session:
-        user_scores = db_session.query(
-            User,
-            func.sum(Result.points_delta).label("total_score")
-        ).outerjoin(User.submissions) \
-            .outerjoin(Submission.results) \
-            .group_by(User.id) \
-            .order_by("total_score") \
-            .all()
 
-        since = datetime.now() - timedelta(hours=24)
-        counts = {}
-        for outcome in Outcome:
-            user_outcome_counts = db_session.query(
-                User.id,
-                func.count(Result.id)
-            ).join(User.submissions) \
-                .join(Submission.results) \
-                .join(Result.match) \
-                .filter(Result.outcome == int(outcome.value), Result.healthy == True, Result.points_delta != 0) \
-                .filter(Match.match_date > since) \
-                .group_by(User.id) \
-                .all()
-
-            counts[outcome] = user_outcome_counts
-
-    # Convert outcomes to wins/losses/draws
-    counts_by_outcome = {o: {user_id: count for user_id, count in counts[o]} for o in Outcome}
+def generate_nickname(db_session: Session):
+    return nickname.claim_new_name(db_session)
 
-    init = int(config_file.get("initial_score"))
-    outcomes = {user.id: {"wins": counts_by_outcome[Outcome.Win].get(user.id, 0),
-                          "losses": counts_by_outcome[Outcome.Loss].get(user.id, 0),
-                          "draws": counts_by_outcome[Outcome.Draw].get(user.id, 0)} for [user, _] in user_scores}
-    scores = [make_scoreboard_entry(user, score, init, outcomes[user.id])
-              for [user, score] in reversed(user_scores)]
 
-    scores.sort(key=lambda e: e["score"], reverse=True)
+def set_user_name_visible(db_session: Session, user: User, visible: bool) -> None:
+    attach_user(db_session, user).display_real_name = visible
+    invalidate_on_commit(db_session, f"user:{user.id}")
 
-    return scores
 
+def make_scoreboard_entry(user_id: int, is_bot: bool, score: Optional[int], init: int, outcomes: dict):
+    return {"user_id": user_id,
+            "score": 0 if score is None else (init + score),
+            "score_text": ("" if score is None else "%.0f" % (init + score)),
+            "is_bot": is_bot,
+            "outcomes": outcomes}
 
-def get_scoreboard(db_session: Session, querying_user: User) -> List[Dict[str, Any]]:
-    scores = get_scoreboard_data()
 
+async def _hydrate_scoreboard(db_session: Session, querying_user: User, entries: List[leaderboard.LeaderboardEntry],
+                              first_rank: int) -> List[Dict[str, Any]]:
+    users = await database.run_sync(get_public_users, db_session, [user_id for user_id, _, _ in entries])
+
+    init = int(config_file.get("initial_score"))
     new_scores = []
-    found_you = False
-    for vs in scores:
-        user = db_session.query(User).get(vs["user_id"])
+    for rank, (user_id, score, outcomes) in enumerate(entries, start=first_rank):
+        user = users.get(user_id, None)
 
+        # If user has been deleted since the leaderboard was updated
         if user is None:
             continue
 
-        is_you = querying_user.id == vs["user_id"]
-        if is_you:
-            found_you = True
-
         new_scores.append({
-            "user": user.to_public_dict(),
-            "is_you": is_you,
-            **vs
+            "user": user,
+            "is_you": querying_user.id == user_id,
+            "rank": rank,
+            **make_scoreboard_entry(user_id, user["is_bot"], score, init, outcomes)
         })
 
+    return new_scores
+
+
+async def get_scoreboard(db_session: Session, querying_user: User) -> List[Dict[str, Any]]:
+    entries = await leaderboard.get_entries()
+    new_scores = await _hydrate_scoreboard(db_session, querying_user, entries, 0)
+
+    found_you = any(vs["is_you"] for vs in new_scores)
     if not found_you:
         new_scores.append({
             "user": querying_user.to_public_dict(),
             "is_you": True,
-            **make_scoreboard_entry(querying_user, None, 0, {"wins": 0, "losses": 0, "draws": 0})
+            "rank": len(new_scores),
+            **make_scoreboard_entry(querying_user.id, querying_user.is_bot, None, 0,
+                                    {"wins": 0, "losses": 0, "draws": 0})
         })
 
     return new_scores
 
 
-@cached(ttl=300)
-def get_leaderboard_graph_data():
-    with cuwais.database.create_session() as db_session:
-        delta_score_buckets = db_session.query(
-            User,
-            func.date_trunc('hour', Match.match_date),
-            func.sum(Result.points_delta).label("delta_score")
-        ).join(User.submissions) \
-            .join(Submission.results) \
-            .join(Result.match) \
-            .group_by(func.date_trunc('hour', Match.match_date),
-                      User.id) \
-            .all()
+async def get_scoreboard_page(db_session: Session, querying_user: User, start: int, stop: int) \
+        -> List[Dict[str, Any]]:
+    """Gets the scoreboard entries ranked from start to stop inclusive, 0-indexed"""
+    if stop < start:
+        return []
+
+    entries = await leaderboard.get_entries(start, stop)
+    return await _hydrate_scoreboard(db_session, querying_user, entries, start)
+
+
+async def get_scoreboard_around_user(db_session: Session, querying_user: User, distance: int) \
+        -> List[Dict[str, Any]]:
+    """Gets the scoreboard entries up to distance places above and below the querying user"""
+    rank = await leaderboard.get_rank(querying_user.id)
+    if rank is None:
+        return []
+
+    return await get_scoreboard_page(db_session, querying_user, max(0, rank - distance), rank + distance)
+
+
+GRAPH_RESOLUTIONS = {"hour": 60 * 60, "day": 24 * 60 * 60, "week": 7 * 24 * 60 * 60}
 
-    deltas = []
-    for user, time, delta in delta_score_buckets:
-        deltas.append({"user_id": user.id, "time": time.timestamp(), "delta": delta})
 
-    return deltas
+async def _get_score_series(deltas: List[score_history.HourlyDelta], since: Optional[float],
+                            until: Optional[float], init: int) -> Dict[int, Tuple[List[float], List[float]]]:
+    """Turns every delta from since onwards into each user's times and running total scores, up to until"""
+    by_user: Dict[int, List[Tuple[float, float]]] = {}
+    for user_id, time, delta in deltas:
+        by_user.setdefault(user_id, []).append((time, delta))
 
+    # Anything before since is the difference between the current score and the deltas since then
+    baselines = {user_id: 0.0 for user_id in by_user}
+    if since is not None:
+        totals = await leaderboard.get_scores(list(by_user.keys()))
+        for user_id, points in by_user.items():
+            total = totals.get(user_id, None)
+            baselines[user_id] = (0.0 if total is None else total) - sum(delta for _, delta in points)
 
-def get_leaderboard_graph(db_session: Session, querying_user_id: int):
-    deltas = get_leaderboard_graph_data()
+    series = {}
+    for user_id, points in by_user.items():
+        points.sort()
+        score = init + baselines[user_id]
+        times, scores = [], []
+        for time, delta in points:
+            if until is not None and time > until:
+                break
+            score += delta
+            times.append(time)
+            scores.append(score)
+        series[user_id] = (times, scores)
+
+    return series
+
+
+async def get_leaderboard_graph(db_session: Session, querying_user_id: int, since: Optional[float] = None,
+                                until: Optional[float] = None, resolution: str = "hour",
+                                max_points: Optional[int] = None, columnar: bool = False):
+    # Cumulative scores are worked back from the current scores, so need every delta up to now
+    deltas = await score_history.get_deltas(since, None if columnar else until)
+    public_users = await database.run_sync(get_public_users, db_session, {user_id for user_id, _, _ in deltas})
+
+    # If a user has been deleted since their deltas were rolled up then drop them
+    deltas = [delta for delta in deltas if delta[0] in public_users]
+    deltas = score_history.bucket_deltas(deltas, GRAPH_RESOLUTIONS[resolution])
 
     users = {}
     init = int(config_file.get("initial_score"))
-    for delta in deltas:
-        other_user_id = delta['user_id']
-        user = db_session.query(User).get(other_user_id)
+    for other_user_id, user in public_users.items():
+        users[str(other_user_id)] = {**user, "is_you": other_user_id == querying_user_id}
+
+    if not columnar:
+        deltas = [{"user_id": user_id, "time": time, "delta": delta} for user_id, time, delta in deltas]
+        return {"users": users, "deltas": deltas, "initial_score": init}
+
+    series = await _get_score_series(deltas, since, until, init)
+    if max_points is not None:
+        series = {user_id: score_history.downsample(times, scores, max_points)
+                  for user_id, (times, scores) in series.items()}
+
+    series = {str(user_id): {"times": times, "scores": scores} for user_id, (times, scores) in series.items()}
+    return {"users": users, "series": series, "initial_score": init}
 
-        # If user has been deleted since the cache
-        if user is None:
-            del deltas[other_user_id]
-            continue
 
-        users[str(other_user_id)] = user.to_public_dict()
-        users[str(other_user_id)]["is_you"] = other_user_id == querying_user_id
+CRASH_PRINTS_LIMIT = 2000
+
+
+def _truncate_prints(prints: Optional[str]) -> Optional[str]:
+    """Keeps the end of a submission's output, which is where the reason it crashed will be"""
+    if prints is None or len(prints) <= CRASH_PRINTS_LIMIT:
+        return prints
+    return "...\n" + prints[-CRASH_PRINTS_LIMIT:]
+
+
+def _latest_results(db_session: Session, submission_ids: List[int]):
+    """A query for the result of each submission in the latest match that it played"""
+    latest_matches = db_session.query(
+        Result.submission_id,
+        func.max(Result.match_id).label("match_id")
+    ).filter(Result.submission_id.in_(submission_ids)) \
+        .group_by(Result.submission_id) \
+        .subquery()
+
+    return db_session.query(Result).join(
+        latest_matches,
+        and_(
+            Result.submission_id == latest_matches.c.submission_id,
+            Result.match_id == latest_matches.c.match_id
+        )
+    )
+
+
+def _get_crash_summaries(submission_ids: List[int]) -> List[Optional[dict]]:
+    with database.create_session() as db_session:
+        results = _latest_results(db_session, submission_ids) \
+            .with_entities(Result.submission_id, Result.result_code, Result.prints) \
+            .all()
 
-    return {"users": users, "deltas": deltas, "initial_score": init}
+    summaries = {s_id: {"result": result, "prints": _truncate_prints(prints)} for s_id, result, prints in results}
+    return [summaries.get(s_id, None) for s_id in submission_ids]
+
+
+@async_cached(ttl=24*60*60, local_ttl=60, local_maxsize=1024,
+              tags=lambda submission_id: [f"submission:{submission_id}"])
+def get_crash_summary(submission_id: int) -> Optional[dict]:
+    """Gets the result code and the end of the prints of a submission's latest match"""
+    return _get_crash_summaries([submission_id])[0]
+
+
+async def get_crash_summaries(submission_ids: List[int]) -> Dict[int, Optional[dict]]:
+    data = await get_crash_summary.get_many([(submission_id,) for submission_id in submission_ids],
+                                            lambda args_list: _get_crash_summaries([s_id for s_id, in args_list]))
+
+    return dict(zip(submission_ids, data))
+
+
+def record_crash_summaries(db_session: Session, match_id: int):
+    """Stores the crash summaries of the submissions which crashed in a match, so they are ready before they're read.
+    Needs to be called after the submissions' tags are invalidated"""
+    crashed = [s_id for s_id, in db_session.query(Result.submission_id)
+               .filter(Result.match_id == match_id, Result.healthy == False)
+               .all()]
+    if len(crashed) == 0:
+        return
+
+    get_crash_summary.prime_many([(submission_id,) for submission_id in crashed],
+                                 lambda args_list: _get_crash_summaries([s_id for s_id, in args_list]))
+
+
+def get_crash_report(db_session: Session, submission_id: int) -> Optional[dict]:
+    """Gets the full recording, result code and prints of a submission's latest match"""
+    result = _latest_results(db_session, [submission_id]) \
+        .join(Result.match) \
+        .with_entities(Match.recording, Result.result_code, Result.prints) \
+        .first()
+
+    if result is None:
+        return None
+
+    recording, result_code, prints = result
+    return {"recording": json.loads(recording), "result": result_code, "prints": prints}
 
 
 def get_all_user_submissions(db_session: Session, user: User, private=False) -> List[dict]:
+    """Gets the dicts of a user's submissions, newest first. Private dicts also say whether each submission has been
+    tested and whether it is healthy. The crash summaries of unhealthy submissions can be found with
+    get_crash_summaries"""
     user_id = user.id
     subs = db_session.execute(
         select(Submission).where(Submission.user_id == user_id).order_by(Submission.submission_date)
@@ -178,101 +288,43 @@ def get_all_user_submissions(db_session: Session, user: User, private=False) ->
     sub_ids = {sub["submission_id"] for sub in sub_dicts}
 
     if private:
-        untested = db_session.query(Submission.id) \
-            .outerjoin(Submission.results) \
-            .filter(Result.id == None, Submission.id.in_(sub_ids)) \
+        counts = db_session.query(
+            Result.submission_id,
+            func.count(Result.id),
+            func.count(Result.id).filter(Result.healthy == True)
+        ).filter(Result.submission_id.in_(sub_ids)) \
+            .group_by(Result.submission_id) \
             .all()
-        untested_ids = {u[0] for u in untested}
+        tested_ids = {s_id for s_id, count, _ in counts if count > 0}
+        healthy_ids = {s_id for s_id, _, healthy_count in counts if healthy_count > 0}
 
-        healthy = db_session.query(
-            Submission.id,
-        ).join(Submission.results) \
-            .group_by(Submission.id) \
-            .filter(Result.healthy == True, Submission.id.in_(sub_ids)) \
-            .all()
-        healthy_ids = {u[0] for u in healthy}
-
-        unhealthy_tested_ids = {s_id for s_id in sub_ids if s_id not in healthy_ids and s_id not in untested_ids}
-        crash_matches = db_session.query(
-            Submission.id,
-            func.max(Match.id).label("match_id")
-        ).join(Submission.results) \
-            .join(Result.match) \
-            .group_by(Submission.id) \
-            .filter(Submission.id.in_(unhealthy_tested_ids)) \
-            .subquery()
-
-        crash_recordings = db_session.query(
-            Submission.id,
-            Match.recording,
-            Result.result_code,
-            Result.prints
-        ).join(Submission.results) \
-            .join(Result.match) \
-            .join(
-            crash_matches,
-            and_(
-                Submission.id == crash_matches.c.id,
-                Match.id == crash_matches.c.match_id
-            )
-        ).all()
-
-        crash_dict = {s_id: {"recording": json.loads(recording), "result": result, "prints": prints}
-                      for s_id, recording, result, prints in crash_recordings}
-
-        sub_dicts = [{**sub, "tested": sub["submission_id"] not in untested_ids,
-                      "healthy": sub["submission_id"] in healthy_ids,
-                      "crash": crash_dict.get(sub["submission_id"], None)}
+        sub_dicts = [{**sub, "tested": sub["submission_id"] in tested_ids,
+                      "healthy": sub["submission_id"] in healthy_ids}
                      for sub in sub_dicts]
 
     return sub_dicts
 
 
-def create_git_submission(db_session: Session, user: User, url: str) -> int:
-    files_hash = repo.download_repository(user.id, url)
-
-    return create_submission(db_session, user, url, files_hash)
-
-
 class SubmissionRawFileData(BaseModel):
     fileName: str
     data: str
 
 
 def create_raw_files_submission(db_session: Session, user: User, files: List[SubmissionRawFileData]) -> int:
-    url = "file://localfiles"
-
-    size = sum([len(v) for f, v in files])
-    if size > int(config_file.get("max_repo_size_bytes")):
-        raise RepoTooBigException(url)
-
-    # Calculate submission hash
-    digest = hashlib.sha256()
-    for file in files:
-        digest.update(file.data.encode())
-    files_hash = cuwais.common.calculate_git_hash(user.id, digest.hexdigest(), url)
+    encoded_files = [(file.fileName, file.data.encode()) for file in files]
+    files_hash = repo.save_files_archive(user.id, [(name, len(data), io.BytesIO(data)) for name, data in encoded_files])
 
-    logging.info(f"New raw submission with hash {files_hash}")
-    archive_dir = get_repo_path(files_hash)
-    if archive_dir.exists():
-        raise AlreadyExistsException(url)
+    return create_submission(db_session, user, repo.RAW_FILES_URL, files_hash)
 
-    # Create tar and save
-    with tarfile.open(archive_dir, mode='w') as tar:
-        for file in files:
-            data = file.data.encode()
-            fileobj = io.BytesIO(data)
-            info = tarfile.TarInfo(name=file.fileName)
-            info.size = len(data)
-            tar.addfile(info, fileobj)
-
-    return create_submission(db_session, user, url, files_hash)
 
+def create_submission(db_session: Session, user: Union[int, User], url: str, files_hash: str) -> int:
+    user_id = user.id if isinstance(user, User) else int(user)
 
-def create_submission(db_session: Session, user: User, url: str, files_hash: str) -> int:
     now = datetime.now(tz=timezone.utc)
-    submission = Submission(user_id=user.id, submission_date=now, url=url, active=True, files_hash=files_hash)
+    submission = Submission(user_id=user_id, submission_date=now, url=url, active=True, files_hash=files_hash)
     db_session.add(submission)
+    db_session.flush()
+    invalidate_on_commit(db_session, f"user:{user_id}")
 
     return submission.id
 
@@ -297,41 +349,74 @@ def is_submission_healthy(db_session: Session, submission_id: int):
 
 
 def is_current_submission(db_session: Session, submission_id: int) -> bool:
-    submission = db_session.query(Submission).get(submission_id)
+    user_id = db_session.query(Submission.user_id).filter(Submission.id == submission_id).scalar()
 
-    if submission is None:
+    if user_id is None:
         return False
 
-    current_submission = get_current_submission(db_session, submission.user_id)
+    return submission_id == get_current_submission_id(db_session, user_id)
 
-    if current_submission is None:
-        return False
 
-    return submission_id == current_submission.id
+def _query_current_submission_ids(db_session: Session, user_ids: List[int]) -> List[Optional[int]]:
+    """Finds the newest active and healthy submission of each user"""
+    current_dates = db_session.query(
+        Submission.user_id,
+        func.max(Submission.submission_date).label("submission_date")
+    ).join(Submission.results) \
+        .filter(Submission.user_id.in_(user_ids), Submission.active == True, Result.healthy == True) \
+        .group_by(Submission.user_id) \
+        .subquery()
+
+    rows = db_session.query(
+        Submission.user_id,
+        Submission.id
+    ).join(
+        current_dates,
+        and_(
+            Submission.user_id == current_dates.c.user_id,
+            Submission.submission_date == current_dates.c.submission_date
+        )
+    ).all()
+
+    current = {}
+    for user_id, submission_id in rows:
+        current.setdefault(user_id, submission_id)
+
+    return [current.get(user_id, None) for user_id in user_ids]
+
+
+@cached(ttl=24*60*60, local_ttl=60, local_maxsize=1024, tags=lambda user_id: [f"user:{user_id}"])
+def _current_submission_id(user_id: int) -> Optional[int]:
+    """The cache of each user's current submission id. It is read through get_current_submission_ids,
+    so that misses are looked up on the caller's session rather than needing a second connection"""
+    with database.create_session() as db_session:
+        return _query_current_submission_ids(db_session, [user_id])[0]
+
+
+def get_current_submission_ids(db_session: Session, user_ids: List[int]) -> Dict[int, Optional[int]]:
+    """Gets the ids of the current submissions of many users. Each is kept until the user adds, toggles or deletes
+    a submission, or one of their submissions gets its first healthy result"""
+    user_ids = list(dict.fromkeys(user_ids))
+    submission_ids = _current_submission_id.get_many([(user_id,) for user_id in user_ids],
+                                                     lambda args_list: _query_current_submission_ids(
+                                                         db_session, [user_id for user_id, in args_list]))
+
+    return dict(zip(user_ids, submission_ids))
+
+
+def get_current_submission_id(db_session: Session, user_id: int) -> Optional[int]:
+    return get_current_submission_ids(db_session, [user_id])[user_id]
 
 
 def get_current_submission(db_session: Session, user: Union[int, User]) -> Optional[Submission]:
     user_id = user.id if isinstance(user, User) else int(user)
 
-    sub_date = db_session.query(
-        func.max(Submission.submission_date).label('maxdate')
-    ).join(Submission.results) \
-        .group_by(Submission.user_id) \
-        .filter(Submission.user_id == user_id, Submission.active == True, Result.healthy == True) \
-        .first()
+    submission_id = get_current_submission_id(db_session, user_id)
 
-    if sub_date is None:
+    if submission_id is None:
         return None
 
-    sub_date = sub_date[0]
-
-    submission = db_session.query(
-        Submission
-    ).filter(Submission.user_id == user_id) \
-        .filter(Submission.submission_date == sub_date) \
-        .first()
-
-    return submission
+    return db_session.query(Submission).get(submission_id)
 
 
 def submission_is_owned_by_user(db_session: Session, submission_id: int, user_id: int) -> bool:
@@ -360,43 +445,89 @@ def set_submission_enabled(db_session: Session, submission_id: int, enabled: boo
         return
 
     res.active = enabled
+    invalidate_on_commit(db_session, f"user:{res.user_id}")
+
+
+def submissions_are_owned_by_user(db_session: Session, submission_ids: List[int], user_id: int) -> bool:
+    if not all(isinstance(submission_id, int) for submission_id in submission_ids):
+        return False
+    if not isinstance(user_id, int):
+        return False
+
+    submission_ids = set(submission_ids)
+    owned = db_session.query(
+        func.count(Submission.id)
+    ).filter(Submission.id.in_(submission_ids), Submission.user_id == user_id) \
+        .scalar()
+
+    return owned == len(submission_ids)
+
+
+def _count_win_loss(submission_ids: List[int]) -> List[dict]:
+    """Counts the outcomes of each submission, all of them and only the healthy ones, in one grouped query"""
+    names = {Outcome.Win: "wins", Outcome.Loss: "losses", Outcome.Draw: "draws"}
+    counts = {submission_id: {**{name: 0 for name in names.values()},
+                              **{name + "_healthy": 0 for name in names.values()}}
+              for submission_id in submission_ids}
+
+    with database.create_session() as db_session:
+        rows = db_session.query(
+            Result.submission_id,
+            Result.outcome,
+            Result.healthy,
+            func.count(Result.id)
+        ).filter(Result.submission_id.in_(list(counts.keys())),
+                 Result.points_delta != 0) \
+            .group_by(Result.submission_id, Result.outcome, Result.healthy) \
+            .all()
+
+    for submission_id, outcome, healthy, count in rows:
+        name = names[Outcome(outcome)]
+        counts[submission_id][name] += count
+        if healthy:
+            counts[submission_id][name + "_healthy"] += count
 
+    return [counts[submission_id] for submission_id in submission_ids]
 
-@cached(ttl=300)
+
+@async_cached(ttl=60*60, local_ttl=30, local_maxsize=1024,
+              tags=lambda submission_id: [f"submission:{submission_id}"])
 def get_submission_win_loss_data(submission_id: int):
-    with cuwais.database.create_session() as db_session:
-        vs = {}
-        for outcome in Outcome:
-            count = db_session.query(
-                func.count(Result.id)
-            ).join(Submission.results) \
-                .group_by(Submission.id) \
-                .filter(Submission.id == submission_id,
-                        Result.outcome == outcome.value,
-                        Result.points_delta != 0) \
-                .first()
-
-            count_healthy = db_session.query(
-                func.count(Result.id)
-            ).join(Submission.results) \
-                .group_by(Submission.id) \
-                .filter(Submission.id == submission_id,
-                        Result.outcome == outcome.value,
-                        Result.healthy == True,
-                        Result.points_delta != 0) \
-                .first()
-
-            count = 0 if count is None else count[0]
-            count_healthy = 0 if count_healthy is None else count_healthy[0]
-
-            vs[outcome] = {"count": count, "count_healthy": count_healthy}
-
-    return {"wins": vs[Outcome.Win]["count"],
-            "losses": vs[Outcome.Loss]["count"],
-            "draws": vs[Outcome.Draw]["count"],
-            "wins_healthy": vs[Outcome.Win]["count_healthy"],
-            "losses_healthy": vs[Outcome.Loss]["count_healthy"],
-            "draws_healthy": vs[Outcome.Draw]["count_healthy"]}
+    return _count_win_loss([submission_id])[0]
+
+
+async def get_submissions_win_loss_data(submission_ids: List[int]) -> Dict[int, dict]:
+    """Gets the win/loss data of many submissions, only counting those which aren't already cached"""
+    submission_ids = list(dict.fromkeys(submission_ids))
+    data = await get_submission_win_loss_data.get_many(
+        [(submission_id,) for submission_id in submission_ids],
+        lambda args_list: _count_win_loss([submission_id for submission_id, in args_list])
+    )
+
+    return dict(zip(submission_ids, data))
+
+
+def get_match_participants(db_session: Session, match_id: int) -> List[Tuple[int, int]]:
+    """Gets the (submission id, user id) of every submission which played in the given match"""
+    return db_session.query(
+        Submission.id,
+        Submission.user_id
+    ).join(Submission.results) \
+        .filter(Result.match_id == match_id) \
+        .all()
+
+
+def get_first_healthy_participants(db_session: Session, match_id: int) -> List[Tuple[int, int]]:
+    """Gets the (submission id, user id) of every submission which got its first healthy result in the given match"""
+    return db_session.query(
+        Submission.id,
+        Submission.user_id
+    ).join(Submission.results) \
+        .filter(Submission.id.in_(select(Result.submission_id).where(Result.match_id == match_id)),
+                Result.healthy == True) \
+        .group_by(Submission.id, Submission.user_id) \
+        .having(func.min(Result.match_id) == match_id) \
+        .all()
 
 
 def get_all_bot_submissions(db_session: Session) -> List[Tuple[User, Submission]]:
@@ -409,6 +540,7 @@ def create_bot(db_session: Session, name: str) -> Optional[User]:
 
     bot = User(nickname=name, real_name=name, is_bot=True)
     db_session.add(bot)
+    nickname.claim_name_on_commit(db_session, name)
 
     return bot
 
@@ -417,10 +549,33 @@ def delete_bot(db_session: Session, bot_id: int) -> None:
     if not isinstance(bot_id, int):
         return
 
+    bot_matches = [match_id for match_id, in db_session.query(Result.match_id)
+                   .join(Result.submission)
+                   .filter(Submission.user_id == bot_id)
+                   .distinct()]
+
+    # Deleting the bot's matches deletes its opponents' results in them too
+    opponents = db_session.query(Submission.id, Submission.user_id) \
+        .join(Submission.results) \
+        .filter(Result.match_id.in_(bot_matches), Submission.user_id != bot_id) \
+        .distinct() \
+        .all()
+    opponent_ids = {user_id for _, user_id in opponents}
+    opponent_deltas = [(user_id, hour, delta)
+                       for user_id, hour, delta in score_history.get_match_deltas(db_session, bot_matches)
+                       if user_id in opponent_ids]
+    invalidate_on_commit(db_session, *[f"user:{user_id}" for user_id in opponent_ids],
+                         *[f"submission:{submission_id}" for submission_id, _ in opponents])
+
+    db_session.query(Result) \
+        .filter(Result.match_id.in_(bot_matches)) \
+        .delete(synchronize_session='fetch')
     db_session.query(Match) \
-        .filter(Result.match_id == Match.id, Result.submission_id == Submission.id, Submission.user_id == bot_id) \
+        .filter(Match.id.in_(bot_matches)) \
         .delete(synchronize_session='fetch')
     delete_user(db_session, bot_id)
+    leaderboard.refresh_users(db_session, opponent_ids)
+    score_history.remove_deltas(opponent_deltas)
 
 
 def delete_user(db_session: Session, user_id: int) -> None:
@@ -431,6 +586,7 @@ def delete_user(db_session: Session, user_id: int) -> None:
     submissions = db_session.query(Submission) \
         .filter(Submission.user_id == user_id).all()
     submission_hashes = [s.files_hash for s in submissions]
+    invalidate_on_commit(db_session, "scoreboard", f"user:{user_id}", *[f"submission:{s.id}" for s in submissions])
 
     # Delete all data
     db_session.query(Result) \
@@ -439,8 +595,13 @@ def delete_user(db_session: Session, user_id: int) -> None:
     db_session.query(Submission) \
         .filter(Submission.user_id == user_id) \
         .delete(synchronize_session='fetch')
-    db_session.delete(db_session.query(User).get(user_id))
+    user = db_session.query(User).get(user_id)
+    user_nickname = user.nickname
+    db_session.delete(user)
     db_session.commit()
+    leaderboard.remove_user(user_id)
+    score_history.remove_user(user_id)
+    nickname.release_name(user_nickname)
 
     # Delete archives
     for sub_hash in submission_hashes:
@@ -454,6 +615,9 @@ def delete_submission(db_session: Session, submission_id: int) -> None:
     # Get submission hashes
     submission: Submission = db_session.query(Submission).get(submission_id)
     submission_hash = submission.files_hash
+    user_id = submission.user_id
+    invalidate_on_commit(db_session, "scoreboard", f"user:{user_id}", f"submission:{submission_id}")
+    deltas = score_history.get_submission_deltas(db_session, submission_id)
 
     # Delete all data
     db_session.query(Result) \
@@ -461,6 +625,8 @@ def delete_submission(db_session: Session, submission_id: int) -> None:
         .delete(synchronize_session='fetch')
     db_session.delete(db_session.query(Submission).get(submission_id))
     db_session.commit()
+    leaderboard.refresh_users(db_session, [user_id])
+    score_history.remove_deltas(deltas)
 
     # Delete archives
     repo.remove_submission_archive(submission_hash)
@@ -489,19 +655,34 @@ def get_submission_hash(db_session: Session, submission_id) -> Optional[str]:
     return submission.files_hash
 
 
-def are_submissions_playable(db_session: Session, ids, userid):
+def get_playable_submission_hashes(db_session: Session, ids: List[int], userid: int) -> Optional[List[str]]:
+    """Gets the files hash of each of the given submissions, or None if any of them can't be played by the given user.
+    A submission can be played if it is healthy and either belongs to the user or is its owner's current submission"""
     if not all(isinstance(x, int) for x in ids):
-        return False
+        return None
     if not isinstance(userid, int):
-        return False
+        return None
+
+    healthy = select(Result.id) \
+        .where(Result.submission_id == Submission.id, Result.healthy == True) \
+        .exists()
+
+    rows = db_session.query(
+        Submission.id,
+        Submission.user_id,
+        Submission.files_hash
+    ).filter(Submission.id.in_(set(ids)), healthy) \
+        .all()
 
-    for submission_id in ids:
-        this_allowed = is_current_submission(db_session, submission_id) \
-                       or submission_is_owned_by_user(db_session, submission_id, userid)
+    # Other users' submissions may only be played if they are current
+    current_ids = get_current_submission_ids(db_session, [user_id for _, user_id, _ in rows if user_id != userid])
+    hashes = {submission_id: files_hash for submission_id, user_id, files_hash in rows
+              if user_id == userid or current_ids[user_id] == submission_id}
+    if not all(submission_id in hashes for submission_id in ids):
+        return None
 
-        this_allowed = this_allowed and is_submission_healthy(db_session, submission_id)
+    return [hashes[submission_id] for submission_id in ids]
 
-        if not this_allowed:
-            return False
 
-    return True
+def are_submissions_playable(db_session: Session, ids, userid):
+    return get_playable_submission_hashes(db_session, ids, userid) is not None
@@ -1,21 +1,61 @@
+import fcntl
+import gzip
+import hashlib
+import json
 import logging
 import os
 import re
+import tarfile
+import time
+import uuid
+from contextlib import contextmanager
 from io import StringIO
 from pathlib import Path
-from shutil import rmtree
-from threading import Lock
+from shutil import rmtree, copyfileobj
+from typing import Optional, Iterable, Tuple, BinaryIO, Set
 
 import cuwais.common
 import sh as sh
 from cuwais.config import config_file
 
-_cloning_dirs_mutex = Lock()
-
+from app.caching import redis_connection
+from app.config import GIT_MIRROR_CACHE_BYTES, ARCHIVE_COMPRESSION, ARCHIVE_COMPRESSION_LEVEL
 
 GIT_BASE_DIR = '/home/web_user/repositories/'
+# Bare mirrors of submitted urls, so that resubmitting a repository only fetches what has changed
+MIRROR_BASE_DIR = Path(GIT_BASE_DIR, "mirrors")
+# The size and last use of each mirror, recorded when it is fetched into, so that evicting doesn't read every mirror
+MIRROR_INDEX_PATH = Path(MIRROR_BASE_DIR, "index.json")
+# Archives are stored once per distinct content, named by the hash of their bytes and sharded by its first characters.
+# The archive of each submission is a hard link to its blob, with a manifest beside it naming the blob's content.
+# Each blob has a refs file listing the submissions using it, as link counts don't survive copies or backups
+BLOB_BASE_DIR = Path(GIT_BASE_DIR, "blobs")
+BLOB_SHARD_DEPTH = 2
+# Archives may be stored compressed, with the suffix of their content encoding after .tar
+ARCHIVE_SUFFIXES = {None: "", "gzip": ".gz"}
+# Compressed archives are only kept if they are at most this fraction of the size, as otherwise reading them costs more
+MAX_COMPRESSED_RATIO = 0.9
 GIT_HASH_RE = re.compile(r"^(?P<hash>[0-9a-f]{40})\s*HEAD$", re.MULTILINE)
 
+# Check that the config option is valid
+assert ARCHIVE_COMPRESSION in ARCHIVE_SUFFIXES
+
+# The url given to submissions uploaded as files rather than cloned
+RAW_FILES_URL = "file://localfiles"
+
+# How often a running clone is checked against the size limit
+CLONE_SIZE_POLL_SECONDS = 0.2
+
+# Rejected urls and commits are remembered so that resubmitting them fails without touching the network.
+# A commit is always the same size, but urls can become valid and a missing commit can be pushed. Clones which fail
+# for any other reason, such as the network, aren't remembered, as trying again may work
+REJECTION_KEY_PREFIX = "repo-rejected-"
+TOO_BIG_TTL = 30 * 24 * 60 * 60
+INVALID_URL_TTL = 2 * 60
+CANT_CLONE_TTL = 10 * 60
+# What git servers say when they don't have a commit
+MISSING_COMMIT_ERRORS = ["not our ref", "couldn't find remote ref", "not allow request for unadvertised object"]
+
 
 class InvalidGitURL(RuntimeError):
     def __init__(self, msg, url):
@@ -28,76 +68,482 @@ class AlreadyExistsException(RuntimeError):
     pass
 
 
-class AlreadyCloningException(RuntimeError):
+class RepoTooBigException(RuntimeError):
     pass
 
 
-class RepoTooBigException(RuntimeError):
+class CantCloneException(RuntimeError):
     pass
 
 
-class CantCloneException(RuntimeError):
+class InvalidArchiveException(RuntimeError):
     pass
 
 
+def _rejection_key(url: str, commit_hash: Optional[str] = None) -> str:
+    return REJECTION_KEY_PREFIX + hashlib.sha256(f"{url}\n{commit_hash or ''}".encode()).hexdigest()
+
+
+def _remember_rejection(url: str, commit_hash: Optional[str], msg: str, ttl: int):
+    redis_connection.set(_rejection_key(url, commit_hash), msg, ex=ttl)
+
+
+def _raise_if_rejected(url: str, commit_hash: Optional[str] = None):
+    msg = redis_connection.get(_rejection_key(url, commit_hash))
+    if msg is None:
+        return
+
+    msg = msg.decode()
+    if commit_hash is None:
+        raise InvalidGitURL(msg, url)
+    if msg == RepoTooBigException.__name__:
+        raise RepoTooBigException(url)
+    raise CantCloneException(url)
+
+
+def _is_missing_commit(e: Exception) -> bool:
+    if not isinstance(e, sh.ErrorReturnCode):
+        return False
+    stderr = e.stderr.decode(errors="replace").lower()
+    return any(error in stderr for error in MISSING_COMMIT_ERRORS)
+
+
+def _run_size_limited(process: sh.RunningCommand, url: str, path: str, start_size: int, max_growth: int):
+    """Waits for git to finish, killing it as soon as what it has written passes the size limit
+    rather than waiting for all of an oversized repository to arrive"""
+    while True:
+        try:
+            process.wait(timeout=CLONE_SIZE_POLL_SECONDS)
+            return
+        except sh.TimeoutException:
+            pass
+
+        if get_dir_size_bytes(path) - start_size > max_growth:
+            process.kill()
+            try:
+                process.wait()
+            except sh.ErrorReturnCode:
+                pass
+            raise RepoTooBigException(url)
+
+
+def _update_mirror(url: str, mirror_dir: Path, commit_hash: str, max_size: int):
+    """Fetches a commit into a mirror and points its HEAD at it, creating the mirror if it doesn't exist yet.
+    Only that commit is fetched, and only the objects that the mirror doesn't already have"""
+    mirror_dir_str = str(mirror_dir.absolute())
+    if not mirror_dir.exists():
+        sh.git.init("--bare", "--quiet", mirror_dir_str)
+        sh.git.remote("add", "origin", url, _cwd=mirror_dir_str)
+
+    # Fetch exactly the commit that was hashed, even if the remote has moved on since.
+    # Servers which support partial clones won't send any file bigger than the limit at all
+    start_size = get_dir_size_bytes(mirror_dir_str)
+    process = sh.git.fetch("--depth=1", "--no-tags", f"--filter=blob:limit={max_size}", "origin", commit_hash,
+                           _cwd=mirror_dir_str, _bg=True, _bg_exc=False)
+    _run_size_limited(process, url, mirror_dir_str, start_size, max_size)
+    sh.git("update-ref", "HEAD", commit_hash, _cwd=mirror_dir_str)
+
+    # Any file left out by the filter was too big
+    buf = StringIO()
+    sh.git("rev-list", "--objects", "--missing=print", commit_hash, _cwd=mirror_dir_str, _out=buf)
+    if any(line.startswith("?") for line in buf.getvalue().splitlines()):
+        raise RepoTooBigException(url)
+
+    buf = StringIO()
+    sh.git("ls-tree", "-r", "-l", commit_hash, _cwd=mirror_dir_str, _out=buf)
+    size = sum(int(line.split()[3]) for line in buf.getvalue().splitlines() if line.split()[1] == "blob")
+    if size > max_size:
+        raise RepoTooBigException(url)
+
+
+def _get_mirror_dir(url: str) -> Path:
+    return Path(MIRROR_BASE_DIR, hashlib.sha256(url.encode()).hexdigest())
+
+
+@contextmanager
+def _path_lock(path: Path, blocking=True):
+    """Locks a path against every thread and worker process, yielding whether the lock was taken.
+    Lock files are never deleted, so that two processes can never hold locks on different files for one path"""
+    with open(str(path) + ".lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_mirror_index() -> dict:
+    """Reads the index of mirrors by name, building it from the mirrors on disk if there isn't one yet.
+    Needs the index lock"""
+    try:
+        with open(MIRROR_INDEX_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {path.name: {"size": get_dir_size_bytes(str(path)), "last_used": path.stat().st_mtime}
+                for path in MIRROR_BASE_DIR.iterdir() if path.is_dir()}
+
+
+def _write_mirror_index(index: dict):
+    partial_path = Path(str(MIRROR_INDEX_PATH) + ".partial")
+    with open(partial_path, "w") as f:
+        json.dump(index, f)
+    os.replace(partial_path, MIRROR_INDEX_PATH)
+
+
+def _record_mirror(mirror_dir: Path, fetched: bool):
+    """Records the size of a mirror after fetching into it, or that it has been deleted. Needs the mirror's lock"""
+    with _path_lock(MIRROR_INDEX_PATH):
+        index = _read_mirror_index()
+        if fetched:
+            index[mirror_dir.name] = {"size": get_dir_size_bytes(str(mirror_dir)), "last_used": time.time()}
+        else:
+            index.pop(mirror_dir.name, None)
+        _write_mirror_index(index)
+
+
+def _evict_mirrors():
+    """Deletes the least recently used mirrors until they all fit in the disk budget"""
+    with _path_lock(MIRROR_INDEX_PATH):
+        index = _read_mirror_index()
+        total_size = sum(entry["size"] for entry in index.values())
+        if total_size <= GIT_MIRROR_CACHE_BYTES:
+            return
+
+        for name, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= GIT_MIRROR_CACHE_BYTES:
+                break
+
+            # Mirrors in use are about to become the most recently used, so are kept
+            mirror_dir = Path(MIRROR_BASE_DIR, name)
+            with _path_lock(mirror_dir, blocking=False) as locked:
+                if locked:
+                    if mirror_dir.exists():
+                        rmtree(str(mirror_dir))
+                    del index[name]
+                    total_size -= entry["size"]
+
+        _write_mirror_index(index)
+
+
 def download_repository(user_id: int, url: str) -> str:
     if "\n" in url:
         raise InvalidGitURL("Invalid URL", url)
 
+    _raise_if_rejected(url)
+
     buf = StringIO()
     try:
         sh.git("ls-remote", url, _out=buf)
     except sh.ErrorReturnCode:
+        _remember_rejection(url, None, "Invalid GIT URL", INVALID_URL_TTL)
         raise InvalidGitURL("Invalid GIT URL", url)
 
     ping_string = str(buf.getvalue())
     match = GIT_HASH_RE.match(ping_string)
     if match is None:
+        _remember_rejection(url, None, "GIT URL has no HEAD", INVALID_URL_TTL)
         raise InvalidGitURL("GIT URL has no HEAD", url)
 
     commit_hash = match.group(1)
-    files_hash = cuwais.common.calculate_git_hash(user_id, commit_hash, url)
+    _raise_if_rejected(url, commit_hash)
 
-    clone_dir = Path(GIT_BASE_DIR, files_hash)
-    clone_dir_str = str(clone_dir.absolute())
+    files_hash = cuwais.common.calculate_git_hash(user_id, commit_hash, url)
 
-    archive_dir = get_repo_path(files_hash)
-    archive_dir_str = str(archive_dir.absolute())
+    partial_archive_dir_str = str(get_repo_path(files_hash).absolute()) + ".partial"
 
-    _cloning_dirs_mutex.acquire()
-    try:
-        if clone_dir.exists():
-            raise AlreadyCloningException(url)
+    MIRROR_BASE_DIR.mkdir(parents=True, exist_ok=True)
+    mirror_dir = _get_mirror_dir(url)
 
-        if archive_dir.exists():
+    # The submission hash depends on the url, so the same submission is only ever being made by whoever holds the lock
+    with _path_lock(mirror_dir):
+        if archive_exists(files_hash):
             raise AlreadyExistsException(url)
 
-        os.mkdir(clone_dir)
+        try:
+            _update_mirror(url, mirror_dir, commit_hash, int(config_file.get("max_repo_size_bytes")))
+
+            sh.git.archive("--output=" + partial_archive_dir_str, "--format=tar", commit_hash, _cwd=str(mirror_dir))
+            _store_archive(Path(partial_archive_dir_str), files_hash)
+            _record_mirror(mirror_dir, fetched=True)
+        except Exception as e:
+            # A failed fetch can leave behind partial packs and objects bigger than the limit, so start again next time
+            if mirror_dir.exists():
+                rmtree(str(mirror_dir))
+                _record_mirror(mirror_dir, fetched=False)
+            if os.path.exists(partial_archive_dir_str):
+                os.remove(partial_archive_dir_str)
+
+            if isinstance(e, RepoTooBigException):
+                _remember_rejection(url, commit_hash, RepoTooBigException.__name__, TOO_BIG_TTL)
+                raise
+
+            logging.exception(e)
+            if _is_missing_commit(e):
+                _remember_rejection(url, commit_hash, CantCloneException.__name__, CANT_CLONE_TTL)
+            raise CantCloneException(url)
+
+    _evict_mirrors()
+
+    return files_hash
+
+
+class _HashingReader:
+    def __init__(self, fileobj: BinaryIO, digest):
+        self._fileobj = fileobj
+        self._digest = digest
+
+    def read(self, size=-1) -> bytes:
+        data = self._fileobj.read(size)
+        self._digest.update(data)
+        return data
+
+
+def save_files_archive(user_id: int, files: Iterable[Tuple[str, int, BinaryIO]]) -> str:
+    """Writes (name, size, file) triples to a new submission archive as they are read, returning its hash.
+    The hash only depends on the contents of the files in order, however they were uploaded"""
+    max_size = int(config_file.get("max_repo_size_bytes"))
+    partial_archive_path = Path(GIT_BASE_DIR, uuid.uuid4().hex + ".partial")
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with tarfile.open(partial_archive_path, mode='w') as tar:
+            for name, file_size, fileobj in files:
+                size += file_size
+                if size > max_size:
+                    raise RepoTooBigException(RAW_FILES_URL)
+
+                info = tarfile.TarInfo(name=name)
+                info.size = file_size
+                tar.addfile(info, _HashingReader(fileobj, digest))
+
+        files_hash = cuwais.common.calculate_git_hash(user_id, digest.hexdigest(), RAW_FILES_URL)
+        logging.info(f"New raw submission with hash {files_hash}")
+        if archive_exists(files_hash):
+            raise AlreadyExistsException(RAW_FILES_URL)
+
+        _store_archive(partial_archive_path, files_hash)
     finally:
-        _cloning_dirs_mutex.release()
+        if partial_archive_path.exists():
+            os.remove(partial_archive_path)
+
+    return files_hash
 
+
+def save_tar_archive(user_id: int, fileobj: BinaryIO) -> str:
+    """Streams an uploaded tar, which may be compressed, into a new submission archive, returning its hash.
+    Only regular files are kept"""
     try:
-        sh.git.clone(url, clone_dir_str, "--depth=1")
+        with tarfile.open(fileobj=fileobj, mode='r|*') as upload:
+            files = ((member.name, member.size, upload.extractfile(member)) for member in upload if member.isfile())
+            return save_files_archive(user_id, files)
+    except tarfile.TarError:
+        raise InvalidArchiveException(RAW_FILES_URL)
+
+
+def _open_decoded(path: Path, encoding: Optional[str]) -> BinaryIO:
+    if encoding == "gzip":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _hash_file(path: Path, encoding: Optional[str] = None) -> str:
+    """Hashes the uncompressed contents of a file"""
+    digest = hashlib.sha256()
+    with _open_decoded(path, encoding) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _encode(partial_archive_path: Path) -> Tuple[Path, Optional[str]]:
+    """Compresses a finished archive in the configured format, returning the path and encoding of whichever is kept"""
+    if ARCHIVE_COMPRESSION is None:
+        return partial_archive_path, None
+
+    encoded_path = Path(str(partial_archive_path) + ARCHIVE_SUFFIXES[ARCHIVE_COMPRESSION])
+    with open(partial_archive_path, "rb") as src, open(encoded_path, "wb") as dst:
+        # Without a timestamp the same archive always compresses to the same bytes
+        with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=ARCHIVE_COMPRESSION_LEVEL, mtime=0) as gz:
+            copyfileobj(src, gz, 1024 * 1024)
+
+    if encoded_path.stat().st_size > partial_archive_path.stat().st_size * MAX_COMPRESSED_RATIO:
+        os.remove(encoded_path)
+        return partial_archive_path, None
+
+    return encoded_path, ARCHIVE_COMPRESSION
+
+
+def _get_blob_path(content_hash: str, encoding: Optional[str] = None) -> Path:
+    shards = [content_hash[i * 2:i * 2 + 2] for i in range(BLOB_SHARD_DEPTH)]
+    return Path(BLOB_BASE_DIR, *shards, content_hash + ".tar" + ARCHIVE_SUFFIXES[encoding])
+
+
+def _find_blob(content_hash: str) -> Optional[Tuple[Path, Optional[str]]]:
+    """Finds a stored blob of the given content, preferring the configured encoding"""
+    encodings = [ARCHIVE_COMPRESSION] + [encoding for encoding in ARCHIVE_SUFFIXES if encoding != ARCHIVE_COMPRESSION]
+    for encoding in encodings:
+        blob_path = _get_blob_path(content_hash, encoding)
+        if blob_path.exists():
+            return blob_path, encoding
+    return None
 
-        size = get_dir_size_bytes(clone_dir_str)
-        if size > int(config_file.get("max_repo_size_bytes")):
-            # TODO: Cache too big entries in redis
-            raise RepoTooBigException(url)
 
-        sh.git.archive("--output=" + archive_dir_str, "--format=tar", "HEAD", _cwd=clone_dir_str)
-    except Exception as e:
-        logging.exception(e)
-        raise CantCloneException(url)
+def _get_manifest_path(files_hash: str) -> Path:
+    return Path(GIT_BASE_DIR, files_hash + ".manifest")
+
+
+def _get_refs_path(blob_path: Path) -> Path:
+    return Path(str(blob_path) + ".refs")
+
+
+def _write_atomically(path: Path, text: str):
+    partial_path = Path(str(path) + ".partial")
+    with open(partial_path, "w") as f:
+        f.write(text)
+    os.replace(partial_path, path)
+
+
+def _read_manifest(files_hash: str) -> Optional[str]:
+    """Gets the content hash of the blob a submission's archive links to, or None if it has no manifest"""
+    try:
+        with open(_get_manifest_path(files_hash)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _read_refs(blob_path: Path) -> Set[str]:
+    try:
+        with open(_get_refs_path(blob_path)) as f:
+            return set(f.read().split())
+    except FileNotFoundError:
+        return set()
+
+
+def _add_ref(blob_path: Path, files_hash: str):
+    """Records a submission as using a blob. Needs the blob store lock"""
+    refs = _read_refs(blob_path)
+    if files_hash not in refs:
+        _write_atomically(_get_refs_path(blob_path), "\n".join(sorted(refs | {files_hash})))
+
+
+def _remove_ref(blob_path: Path, files_hash: str):
+    """Records a submission as no longer using a blob. Needs the blob store lock"""
+    refs = _read_refs(blob_path)
+    if files_hash in refs:
+        _write_atomically(_get_refs_path(blob_path), "\n".join(sorted(refs - {files_hash})))
+
+
+def _drop_unused_blobs(content_hash: str):
+    """Deletes the blobs of the given content that no submission uses any more. Needs the blob store lock.
+    Archives are links rather than references, so this never loses the archive of a submission it missed"""
+    for encoding in ARCHIVE_SUFFIXES:
+        blob_path = _get_blob_path(content_hash, encoding)
+        if len(_read_refs(blob_path)) == 0:
+            for path in [blob_path, _get_refs_path(blob_path)]:
+                if path.exists():
+                    os.remove(path)
+
+
+def _store_archive(partial_archive_path: Path, files_hash: str, replace=False):
+    """Moves a finished, uncompressed archive into the blob store and links it in as the archive of the submission.
+    It is compressed if configured to, unless the store already holds the same content in the configured encoding.
+    If replace is set then an existing archive of the submission with the same content is swapped for this one"""
+    content_hash = _hash_file(partial_archive_path)
+    encoded = None
+    linked_path = None
+    try:
+        # Compress outside the lock if it will probably be needed, as that's the slow part
+        stored = _find_blob(content_hash)
+        if stored is None or stored[1] != ARCHIVE_COMPRESSION:
+            encoded = _encode(partial_archive_path)
+
+        # Stops a blob being deleted by its last user between finding it and linking to it
+        with _path_lock(BLOB_BASE_DIR):
+            old_archive = get_archive(files_hash)
+            if old_archive is not None and not replace:
+                raise AlreadyExistsException(files_hash)
+            old_content_hash = _read_manifest(files_hash)
+
+            # Look again, as blobs may have come or gone since
+            stored = _find_blob(content_hash)
+            if stored is not None and stored[1] == ARCHIVE_COMPRESSION:
+                blob_path, encoding = stored
+            else:
+                if encoded is None:
+                    encoded = _encode(partial_archive_path)
+                encoded_path, encoding = encoded
+                blob_path = _get_blob_path(content_hash, encoding)
+                if not blob_path.exists():
+                    blob_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.link(encoded_path, blob_path)
+
+            # Linking then renaming swaps an existing archive for the new one atomically
+            archive_path = get_repo_path(files_hash, encoding)
+            linked_path = Path(str(archive_path) + ".link")
+            os.link(blob_path, linked_path)
+            os.replace(linked_path, archive_path)
+            _write_atomically(_get_manifest_path(files_hash), content_hash)
+            _add_ref(blob_path, files_hash)
+            if old_archive is not None and old_archive[0] != archive_path:
+                os.remove(old_archive[0])
+            if old_archive is not None and old_content_hash is not None:
+                old_blob_path = _get_blob_path(old_content_hash, old_archive[1])
+                if old_blob_path != blob_path:
+                    _remove_ref(old_blob_path, files_hash)
+                    _drop_unused_blobs(old_content_hash)
+            _drop_unused_blobs(content_hash)
     finally:
-        if clone_dir.exists():
-            rmtree(clone_dir_str)
+        leftovers = {partial_archive_path, linked_path}
+        if encoded is not None:
+            leftovers.add(encoded[0])
+        for path in leftovers - {None}:
+            if path.exists():
+                os.remove(path)
 
-    return files_hash
+
+def restore_archive(files_hash: str) -> bool:
+    """Rewrites the archive of a submission in the configured encoding, moving it into the blob store
+    if it was made before there was one or before archives had manifests. Returns whether it was rewritten"""
+    archive = get_archive(files_hash)
+    if archive is None:
+        raise FileNotFoundError(get_repo_path(files_hash))
+
+    archive_path, encoding = archive
+    if encoding == ARCHIVE_COMPRESSION and _read_manifest(files_hash) is not None:
+        return False
+
+    partial_archive_path = Path(GIT_BASE_DIR, uuid.uuid4().hex + ".partial")
+    with _open_decoded(archive_path, encoding) as src, open(partial_archive_path, "wb") as dst:
+        copyfileobj(src, dst, 1024 * 1024)
+    _store_archive(partial_archive_path, files_hash, replace=True)
+    return True
 
 
 def remove_submission_archive(files_hash):
-    archive_dir = Path(GIT_BASE_DIR, files_hash + ".tar")
-    os.remove(archive_dir)
+    archive = get_archive(files_hash)
+    if archive is None:
+        raise FileNotFoundError(get_repo_path(files_hash))
+
+    archive_path, encoding = archive
+    content_hash = _read_manifest(files_hash)
+    if content_hash is None:
+        # Archives made before they had manifests have to be read to find their blob, if they have one
+        content_hash = _hash_file(archive_path, encoding)
+
+    with _path_lock(BLOB_BASE_DIR):
+        os.remove(archive_path)
+        manifest_path = _get_manifest_path(files_hash)
+        if manifest_path.exists():
+            os.remove(manifest_path)
+        _remove_ref(_get_blob_path(content_hash, encoding), files_hash)
+        _drop_unused_blobs(content_hash)
 
 
 def get_dir_size_bytes(path) -> int:
@@ -105,10 +551,35 @@ def get_dir_size_bytes(path) -> int:
     for dir_path, _, filenames in os.walk(path):
         for f in filenames:
             fp = os.path.join(dir_path, f)
-            total_size += os.path.getsize(fp)
+            try:
+                total_size += os.path.getsize(fp)
+            except FileNotFoundError:
+                # Git renames and removes temporary files while it is running
+                pass
 
     return total_size
 
 
-def get_repo_path(digest: str):
-    return Path(GIT_BASE_DIR, digest + ".tar")
+def get_repo_path(digest: str, encoding: Optional[str] = None):
+    return Path(GIT_BASE_DIR, digest + ".tar" + ARCHIVE_SUFFIXES[encoding])
+
+
+def get_archive(digest: str) -> Optional[Tuple[Path, Optional[str]]]:
+    """Finds the archive of a submission however it is stored, returning its path and content encoding"""
+    for encoding in ARCHIVE_SUFFIXES:
+        path = get_repo_path(digest, encoding)
+        if path.exists():
+            return path, encoding
+    return None
+
+
+def archive_exists(digest: str) -> bool:
+    return get_archive(digest) is not None
+
+
+def open_archive(digest: str) -> BinaryIO:
+    """Opens the uncompressed tar of a submission, decompressing it if it is stored compressed"""
+    archive = get_archive(digest)
+    if archive is None:
+        raise FileNotFoundError(get_repo_path(digest))
+    return _open_decoded(*archive)
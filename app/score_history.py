@@ -0,0 +1,230 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple, Dict
+
+from cuwais.database import Submission, Result, Match
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app import database
+from app.caching import redis_connection, async_redis_connection, async_cached, try_acquire_lease, release_lease
+
+HOURS_KEY = "score-history-hours"
+CLOSED_UNTIL_KEY = "score-history-closed-until"
+BUCKET_KEY_PREFIX = "score-history-hour-"
+
+# Leave time for results of matches played at the end of an hour to be recorded before it is rolled up
+CLOSE_DELAY = timedelta(minutes=5)
+# Results can still be recorded later than that, e.g. if the runner falls behind, so each roll up also redoes the hours
+# closed this long before it
+REAGGREGATE_WINDOW = timedelta(hours=6)
+# Until there has been a roll up, only this many of the latest hours are summed from the results
+BACKFILL_WINDOW = timedelta(hours=24)
+
+_CLOSE_LEASE_TTL = 5 * 60
+
+_background_tasks = set()
+
+HourlyDelta = Tuple[int, float, float]
+
+
+def _bucket_key(hour: int) -> str:
+    return BUCKET_KEY_PREFIX + str(hour)
+
+
+def _hour_start(date: datetime) -> datetime:
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+def _closable_until() -> datetime:
+    return _hour_start(datetime.now() - CLOSE_DELAY)
+
+
+def _query_deltas(db_session: Session, start: Optional[datetime], end: Optional[datetime],
+                  submission_id: Optional[int] = None, match_ids=None) -> List[HourlyDelta]:
+    """Sums the points deltas of each user in each hour from start (inclusive) to end (exclusive)"""
+    hour = func.date_trunc('hour', Match.match_date)
+    query = db_session.query(
+        Submission.user_id,
+        hour,
+        func.sum(Result.points_delta)
+    ).join(Submission.results) \
+        .join(Result.match)
+
+    if start is not None:
+        query = query.filter(Match.match_date >= start)
+    if end is not None:
+        query = query.filter(Match.match_date < end)
+    if submission_id is not None:
+        query = query.filter(Submission.id == submission_id)
+    if match_ids is not None:
+        query = query.filter(Match.id.in_(match_ids))
+
+    rows = query.group_by(hour, Submission.user_id).all()
+
+    return [(user_id, bucket.timestamp(), delta) for user_id, bucket, delta in rows]
+
+
+def close_hours(backfill=False):
+    """Rolls up every hour which has finished since the last roll up, and rolls up the hours in the reaggregate window
+    before it again. If there has never been a roll up, or backfill is set, then the whole history is rolled up from
+    scratch. Only one worker rolls up at a time"""
+    token = try_acquire_lease(CLOSED_UNTIL_KEY, _CLOSE_LEASE_TTL)
+    if token is None:
+        return
+
+    try:
+        end = _closable_until()
+        closed_until = None if backfill else redis_connection.get(CLOSED_UNTIL_KEY)
+        closed_until = None if closed_until is None else datetime.fromtimestamp(float(closed_until))
+        if closed_until is not None and closed_until >= end:
+            return
+        start = None if closed_until is None else closed_until - REAGGREGATE_WINDOW
+
+        with database.create_session() as db_session:
+            deltas = _query_deltas(db_session, start, end)
+
+        buckets: Dict[int, Dict[str, float]] = {}
+        for user_id, hour, delta in deltas:
+            buckets.setdefault(int(hour), {})[str(user_id)] = delta
+
+        # Replace every hour being rolled up, as some may no longer have any deltas
+        redo_from = "-inf" if start is None else start.timestamp()
+        pipe = redis_connection.pipeline(transaction=True)
+        for hour in redis_connection.zrangebyscore(HOURS_KEY, redo_from, "+inf"):
+            pipe.delete(_bucket_key(int(hour)))
+        pipe.zremrangebyscore(HOURS_KEY, redo_from, "+inf")
+        for hour, fields in buckets.items():
+            pipe.hset(_bucket_key(hour), mapping=fields)
+        if len(buckets) != 0:
+            pipe.zadd(HOURS_KEY, {str(hour): hour for hour in buckets})
+        pipe.set(CLOSED_UNTIL_KEY, end.timestamp())
+        pipe.execute()
+
+        if start is None:
+            logging.info(f"Backfilled score history with {len(buckets)} hours")
+    finally:
+        release_lease(CLOSED_UNTIL_KEY, token)
+
+
+def get_submission_deltas(db_session: Session, submission_id: int) -> List[HourlyDelta]:
+    return _query_deltas(db_session, None, None, submission_id=submission_id)
+
+
+def get_match_deltas(db_session: Session, match_ids) -> List[HourlyDelta]:
+    return _query_deltas(db_session, None, None, match_ids=match_ids)
+
+
+def remove_deltas(deltas: List[HourlyDelta]):
+    """Takes deltas, e.g. those of a deleted submission, back out of the hours which have been rolled up"""
+    closed_until = redis_connection.get(CLOSED_UNTIL_KEY)
+    if closed_until is None:
+        return
+
+    pipe = redis_connection.pipeline(transaction=False)
+    for user_id, hour, delta in deltas:
+        if hour < float(closed_until):
+            pipe.hincrbyfloat(_bucket_key(int(hour)), str(user_id), -delta)
+    pipe.execute()
+
+
+def remove_user(user_id: int):
+    hours = redis_connection.zrange(HOURS_KEY, 0, -1)
+
+    pipe = redis_connection.pipeline(transaction=False)
+    for hour in hours:
+        pipe.hdel(_bucket_key(int(hour)), str(user_id))
+    pipe.execute()
+
+
+@async_cached(ttl=60, local_ttl=10, tags=["scoreboard"])
+def _get_open_deltas(closed_until: float) -> List[HourlyDelta]:
+    with database.create_session() as db_session:
+        return _query_deltas(db_session, datetime.fromtimestamp(closed_until), None)
+
+
+async def get_deltas(since: Optional[float] = None, until: Optional[float] = None) -> List[HourlyDelta]:
+    """Gets the (user id, hour, points delta) of each user in each hour with a start time between since and until.
+    Finished hours come from the roll up, and only the hours after it are summed from the results. Until the first
+    roll up has finished, only the hours in the backfill window are returned"""
+    closed_until = await async_redis_connection.get(CLOSED_UNTIL_KEY)
+    if closed_until is not None and float(closed_until) < _closable_until().timestamp():
+        await database.run_sync(close_hours)
+        closed_until = await async_redis_connection.get(CLOSED_UNTIL_KEY)
+
+    if closed_until is None:
+        # Backfilling reads the whole history, so it runs in the background while the latest hours are served
+        task = asyncio.ensure_future(database.run_sync(close_hours))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        closed_until = (_closable_until() - BACKFILL_WINDOW).timestamp()
+    closed_until = float(closed_until)
+
+    hours = await async_redis_connection.zrangebyscore(HOURS_KEY,
+                                                       "-inf" if since is None else since,
+                                                       f"({closed_until}" if until is None or until >= closed_until
+                                                       else until)
+    pipe = async_redis_connection.pipeline(transaction=False)
+    for hour in hours:
+        pipe.hgetall(_bucket_key(int(hour)))
+    buckets = await pipe.execute()
+
+    deltas = [(int(user_id), float(hour), float(delta))
+              for hour, fields in zip(hours, buckets)
+              for user_id, delta in fields.items()]
+
+    if until is None or until >= closed_until:
+        open_deltas = await _get_open_deltas(closed_until)
+        deltas += [(user_id, hour, delta) for user_id, hour, delta in open_deltas
+                   if (since is None or hour >= since) and (until is None or hour <= until)]
+
+    return deltas
+
+
+def bucket_deltas(deltas: List[HourlyDelta], resolution: int) -> List[HourlyDelta]:
+    """Sums hourly deltas into coarser buckets, each resolution seconds long"""
+    if resolution <= 60 * 60:
+        return deltas
+
+    buckets: Dict[Tuple[int, float], float] = {}
+    for user_id, hour, delta in deltas:
+        key = (user_id, hour // resolution * resolution)
+        buckets[key] = buckets.get(key, 0) + delta
+
+    return [(user_id, time, delta) for (user_id, time), delta in buckets.items()]
+
+
+def downsample(times: List[float], values: List[float], max_points: int) -> Tuple[List[float], List[float]]:
+    """Picks at most max_points points which keep the shape of a series, using Largest-Triangle-Three-Buckets"""
+    n = len(times)
+    max_points = max(max_points, 3)
+    if n <= max_points:
+        return times, values
+
+    # Always keep the first and last points, and choose one from each of the buckets between them
+    chosen = [0]
+    bucket_size = (n - 2) / (max_points - 2)
+    previous = 0
+    for i in range(max_points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        if next_end <= end:
+            next_end = n
+            end = min(end, n - 1)
+
+        avg_time = sum(times[end:next_end]) / (next_end - end)
+        avg_value = sum(values[end:next_end]) / (next_end - end)
+
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((times[previous] - avg_time) * (values[j] - values[previous])
+                       - (times[previous] - times[j]) * (avg_value - values[previous]))
+            if area > best_area:
+                best, best_area = j, area
+        chosen.append(best)
+        previous = best
+    chosen.append(n - 1)
+
+    return [times[i] for i in chosen], [values[i] for i in chosen]
@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Thread, Lock
+from typing import Optional, Dict
+
+from app import repo, database, queries
+from app.caching import redis_connection, async_redis_connection
+from app.config import CLONE_CONCURRENCY
+
+JOB_KEY_PREFIX = "submission-job-"
+ACTIVE_JOB_KEY_PREFIX = "submission-job-active-"
+ALIVE_JOB_KEY_PREFIX = "submission-job-alive-"
+JOB_TTL = 24 * 60 * 60
+
+# Unfinished jobs are only kept alive while the worker running them heartbeats them,
+# so a job lost to a restart doesn't stay queued, or stop its user resubmitting, for long
+HEARTBEAT_TTL = 60
+_HEARTBEAT_INTERVAL = 15
+
+QUEUED = "queued"
+CLONING = "cloning"
+DONE = "done"
+FAILED = "failed"
+
+# The keys of the localised messages for each reason a clone can fail
+_FAILURE_REASONS = {
+    repo.InvalidGitURL: "invalid-url",
+    repo.AlreadyExistsException: "already-submitted",
+    repo.RepoTooBigException: "too-large",
+    repo.CantCloneException: "clone-fail",
+}
+
+# Sets the active job of a user's url unless it has one, returning whichever job is active
+_CLAIM_ACTIVE_JOB_LUA = """
+local existing = redis.call("get", KEYS[1])
+if existing then
+    return existing
+end
+redis.call("set", KEYS[1], ARGV[1], "ex", ARGV[2])
+return ARGV[1]
+"""
+_claim_active_job_script = async_redis_connection.register_script(_CLAIM_ACTIVE_JOB_LUA)
+
+_executor = ThreadPoolExecutor(max_workers=CLONE_CONCURRENCY, thread_name_prefix="clone")
+
+# The unfinished jobs of this worker, and their active keys
+_live_jobs: Dict[str, Optional[str]] = {}
+_live_jobs_mutex = Lock()
+_heartbeat_thread = None
+
+
+class JobFailedException(RuntimeError):
+    def __init__(self, reason: str):
+        RuntimeError.__init__(self, reason)
+        self.reason = reason
+
+
+def _job_key(job_id: str) -> str:
+    return JOB_KEY_PREFIX + job_id
+
+
+def _active_job_key(user_id: int, url: str) -> str:
+    return ACTIVE_JOB_KEY_PREFIX + hashlib.sha256(f"{user_id}:{url}".encode()).hexdigest()
+
+
+def _alive_job_key(job_id: str) -> str:
+    return ALIVE_JOB_KEY_PREFIX + job_id
+
+
+def _heartbeat_forever():
+    while True:
+        time.sleep(_HEARTBEAT_INTERVAL)
+        with _live_jobs_mutex:
+            jobs = list(_live_jobs.items())
+        if len(jobs) == 0:
+            continue
+
+        try:
+            pipe = redis_connection.pipeline(transaction=False)
+            for job_id, active_key in jobs:
+                pipe.expire(_alive_job_key(job_id), HEARTBEAT_TTL)
+                if active_key is not None:
+                    pipe.expire(active_key, HEARTBEAT_TTL)
+            pipe.execute()
+        except Exception as e:
+            logging.exception(e)
+
+
+async def _create_job(job_id: str, user_id: int, url: str, active_key: Optional[str] = None):
+    global _heartbeat_thread
+
+    with _live_jobs_mutex:
+        _live_jobs[job_id] = active_key
+        if _heartbeat_thread is None:
+            _heartbeat_thread = Thread(target=_heartbeat_forever, daemon=True)
+            _heartbeat_thread.start()
+
+    pipe = async_redis_connection.pipeline(transaction=True)
+    pipe.hset(_job_key(job_id), mapping={"state": QUEUED, "user_id": user_id, "url": url})
+    pipe.expire(_job_key(job_id), JOB_TTL)
+    pipe.set(_alive_job_key(job_id), 1, ex=HEARTBEAT_TTL)
+    await pipe.execute()
+
+
+def _finish_job(job_id: str):
+    with _live_jobs_mutex:
+        active_key = _live_jobs.pop(job_id, None)
+
+    pipe = redis_connection.pipeline(transaction=False)
+    pipe.delete(_alive_job_key(job_id))
+    if active_key is not None:
+        pipe.delete(active_key)
+    pipe.execute()
+
+
+def _set_state(job_id: str, state: str, **fields):
+    redis_connection.hset(_job_key(job_id), mapping={"state": state, **fields})
+
+
+def _run(job_id: str, user_id: int, url: str) -> int:
+    try:
+        _set_state(job_id, CLONING)
+        files_hash = repo.download_repository(user_id, url)
+
+        with database.create_session() as db_session:
+            submission_id = queries.create_submission(db_session, user_id, url, files_hash)
+            db_session.commit()
+
+        _set_state(job_id, DONE, submission_id=submission_id)
+        return submission_id
+    except Exception as e:
+        reason = _FAILURE_REASONS.get(type(e), None)
+        if reason is None:
+            logging.exception(e)
+            reason = "clone-fail"
+        _set_state(job_id, FAILED, reason=reason)
+        raise JobFailedException(reason)
+    finally:
+        _finish_job(job_id)
+
+
+async def submit(user_id: int, url: str) -> str:
+    """Queues a git repository to be cloned and added as a submission, returning the id of the job doing it.
+    If the same user is already waiting on the same url then the id of that job is returned instead"""
+    job_id = uuid.uuid4().hex
+    active_key = _active_job_key(user_id, url)
+    active_job_id = (await _claim_active_job_script(keys=[active_key], args=[job_id, HEARTBEAT_TTL])).decode()
+    if active_job_id != job_id:
+        return active_job_id
+
+    await _create_job(job_id, user_id, url, active_key)
+    _executor.submit(_run, job_id, user_id, url)
+    return job_id
+
+
+async def run(user_id: int, url: str) -> int:
+    """Clones a git repository and adds it as a submission on the clone pool, waiting for it to finish.
+    Raises a JobFailedException with the reason if it can't be added"""
+    job_id = uuid.uuid4().hex
+    await _create_job(job_id, user_id, url)
+
+    future: Future = _executor.submit(_run, job_id, user_id, url)
+    return await asyncio.wrap_future(future)
+
+
+async def get_job(job_id: str) -> Optional[dict]:
+    """Gets the user id, url, state, and either the submission id or the reason it failed of a job"""
+    pipe = async_redis_connection.pipeline(transaction=True)
+    pipe.hgetall(_job_key(job_id))
+    pipe.exists(_alive_job_key(job_id))
+    fields, alive = await pipe.execute()
+    if len(fields) == 0:
+        return None
+
+    job = {key.decode(): value.decode() for key, value in fields.items()}
+    if job["state"] in (QUEUED, CLONING) and not alive:
+        # The worker running it stopped before it finished
+        job["state"] = FAILED
+        job["reason"] = "clone-fail"
+    job["user_id"] = int(job["user_id"])
+    if "submission_id" in job:
+        job["submission_id"] = int(job["submission_id"])
+    return job
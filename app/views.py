@@ -1,28 +1,32 @@
 import asyncio
+import io
 import json
 import logging
+import time
 from datetime import timedelta, datetime
 from enum import Enum
 from json import JSONDecodeError
 from typing import Optional, List, Literal, Tuple
 
-import cuwais.database
 import jwt
 import websockets
 from cuwais.config import config_file
 from cuwais.database import User
-from fastapi import FastAPI, HTTPException, Security, Cookie, WebSocket
+from fastapi import FastAPI, HTTPException, Security, Cookie, WebSocket, Depends, Request
 from fastapi.security import SecurityScopes
 from fastapi_utils.timing import add_timing_middleware
 from jwt import DecodeError, InvalidTokenError
 from pydantic import ValidationError
 from pydantic.main import BaseModel
+from sqlalchemy.orm import Session
 from starlette import status
-from starlette.responses import JSONResponse, Response, FileResponse
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response, FileResponse, StreamingResponse
 from websockets.exceptions import ConnectionClosed
 
-from app import login, queries, repo
-from app.config import DEBUG, PROFILE, ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ACCESS_TOKEN_ALGORITHM, SECURE
+from app import login, queries, repo, caching, database, events, leaderboard, score_history, submission_jobs
+from app.config import DEBUG, PROFILE, ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ACCESS_TOKEN_ALGORITHM, SECURE, \
+    UNTESTED_SUBMISSION_MESSAGE, INVALID_ARCHIVE_MESSAGE
 from app.default_submissions import DEFAULT_SUBMISSION_TAR_PATH, DEFAULT_SUBMISSION_ZIP_PATH
 from app.queries import SubmissionRawFileData
 
@@ -33,11 +37,42 @@ if DEBUG and PROFILE:
 logging.basicConfig(level=logging.DEBUG if DEBUG else logging.WARNING)
 
 
+@app.on_event("startup")
+async def start_background_work():
+    events.start_listening()
+    login.start_certs_refresh()
+
+
 class TokenData(BaseModel):
     username: Optional[str] = None
     scopes: List[str] = []
 
 
+# Every request carries its session token, so remember recently decoded ones rather than checking signatures each time
+_decoded_tokens = caching.LocalCache(maxsize=4096, ttl=60)
+
+
+def decode_session_token(session_jwt: str) -> Optional[Tuple[TokenData, int]]:
+    decoded = _decoded_tokens.get(session_jwt)
+    if decoded is not None:
+        return decoded
+
+    try:
+        payload = jwt.decode(session_jwt, SECRET_KEY, algorithms=[ACCESS_TOKEN_ALGORITHM])
+        username: str = payload.get("sub")
+        exp: int = payload.get("exp")
+        if username is None:
+            return None
+        token_scopes = payload.get("scopes", [])
+        token_data = TokenData(scopes=token_scopes, username=username)
+    except (DecodeError, ValidationError, InvalidTokenError):
+        return None
+
+    # Never remember a token for longer than it is valid
+    _decoded_tokens.set(session_jwt, (token_data, exp), ttl=None if exp is None else exp - time.time())
+    return token_data, exp
+
+
 class Status(Enum):
     SUCCESS = "success"
     RESENT = "resent"
@@ -54,10 +89,6 @@ def make_success_response(data=None):
     return make_response(Status.SUCCESS, data)
 
 
-def make_resent_response():
-    return make_response(Status.RESENT)
-
-
 def make_fail_response(message):
     return make_response(Status.FAIL, {"message": message})
 
@@ -65,27 +96,35 @@ def make_fail_response(message):
 async def get_current_user_or_none(security_scopes: SecurityScopes,
                                    response: Response,
                                    session_jwt: Optional[str] = Cookie(None),
-                                   log_out: Optional[str] = Cookie(None)) -> Optional[User]:
-    return (await _get_current_user_impl(security_scopes, response, session_jwt, log_out, raise_on_none=False))[0]
+                                   log_out: Optional[str] = Cookie(None),
+                                   db_session: Session = Depends(database.get_db_session)) -> Optional[User]:
+    return (await _get_current_user_impl(security_scopes, response, db_session, session_jwt, log_out,
+                                         raise_on_none=False))[0]
 
 
 async def get_current_user_and_timeout_or_none(security_scopes: SecurityScopes,
                                                response: Response,
                                                session_jwt: Optional[str] = Cookie(None),
-                                               log_out: Optional[str] = Cookie(None)) -> (Optional[User], int):
-    return await _get_current_user_impl(security_scopes, response, session_jwt, log_out, raise_on_none=False)
+                                               log_out: Optional[str] = Cookie(None),
+                                               db_session: Session = Depends(database.get_db_session)) \
+        -> (Optional[User], int):
+    return await _get_current_user_impl(security_scopes, response, db_session, session_jwt, log_out,
+                                        raise_on_none=False)
 
 
 async def get_current_user(security_scopes: SecurityScopes,
                            response: Response,
                            session_jwt: Optional[str] = Cookie(None),
-                           log_out: Optional[str] = Cookie(None)) -> User:
-    user, exp = await _get_current_user_impl(security_scopes, response, session_jwt, log_out, raise_on_none=True)
+                           log_out: Optional[str] = Cookie(None),
+                           db_session: Session = Depends(database.get_db_session)) -> User:
+    user, exp = await _get_current_user_impl(security_scopes, response, db_session, session_jwt, log_out,
+                                             raise_on_none=True)
     return user
 
 
 async def _get_current_user_impl(security_scopes: SecurityScopes,
                                  response: Response,
+                                 db_session: Session,
                                  session_jwt: Optional[str] = Cookie(None),
                                  log_out: Optional[str] = Cookie(None),
                                  raise_on_none: bool = True) -> (Optional[User], int):
@@ -115,17 +154,11 @@ async def _get_current_user_impl(security_scopes: SecurityScopes,
     if session_jwt is None:
         return on_none()
 
-    try:
-        payload = jwt.decode(session_jwt, SECRET_KEY, algorithms=[ACCESS_TOKEN_ALGORITHM])
-        username: str = payload.get("sub")
-        exp: int = payload.get("exp")
-        if username is None:
-            return on_none()
-        token_scopes = payload.get("scopes", [])
-        token_data = TokenData(scopes=token_scopes, username=username)
-    except (DecodeError, ValidationError, InvalidTokenError):
+    decoded = decode_session_token(session_jwt)
+    if decoded is None:
         return on_none()
-    user = queries.get_user(token_data.username)
+    token_data, exp = decoded
+    user = await queries.get_user(token_data.username)
     if user is None:
         return on_none()
     for scope in security_scopes.scopes:
@@ -135,7 +168,9 @@ async def _get_current_user_impl(security_scopes: SecurityScopes,
                 detail="Not enough permissions",
                 headers={"WWW-Authenticate": authenticate_value},
             )
-    return user, exp
+
+    # Endpoints get the user in the same session as the rest of the request
+    return queries.attach_user(db_session, user), exp
 
 
 def abort404():
@@ -171,6 +206,21 @@ def validate_submission_playable(db_session, user, submission_id):
            and queries.is_submission_healthy(db_session, submission_id)
 
 
+def transform_scoreboard_entry(item, position):
+    return {
+        "position": position,
+        "name": item["user"]["display_name"],
+        "is_real_name": item["user"]["display_real_name"],
+        "nickname": item["user"]["nickname"],
+        "wins": item["outcomes"]["wins"],
+        "losses": item["outcomes"]["losses"],
+        "draws": item["outcomes"]["draws"],
+        "score": item["score_text"],
+        "is_bot": item["is_bot"],
+        "is_you": item["is_you"]
+    }
+
+
 def create_access_token(token_data: dict, expires_delta: timedelta):
     to_encode = token_data.copy()
     expire = datetime.utcnow() + expires_delta
@@ -188,6 +238,7 @@ def get_scopes(user: User):
         scopes.append("bots.view")
         scopes.append("bot.remove")
         scopes.append("service.status")
+        scopes.append("leaderboard.rebuild")
 
     return scopes
 
@@ -197,14 +248,16 @@ class GoogleTokenData(BaseModel):
 
 
 @app.post('/exchange_google_token', response_class=JSONResponse)
-async def exchange_google_token(data: GoogleTokenData, response: Response):
-    with cuwais.database.create_session() as db_session:
+async def exchange_google_token(data: GoogleTokenData, response: Response,
+                                db_session: Session = Depends(database.get_db_session)):
+    def log_in(db_session):
         user = login.get_user_from_google_token(db_session, data.google_token)
         db_session.commit()
+        leaderboard.add_user(user.id)
+
+        return user.id, get_scopes(user), user.to_private_dict()
 
-        user_id = user.id
-        scopes = get_scopes(user)
-        user_dict = user.to_private_dict()
+    user_id, scopes, user_dict = await database.run_sync(log_in, db_session)
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -251,9 +304,9 @@ class GetGameData(BaseModel):
 
 
 @app.post('/get_game_data', response_class=JSONResponse)
-async def get_game_data(data: GetGameData, user: User = Security(get_current_user, scopes=["submission.play"])):
-    with cuwais.database.create_session() as db_session:
-        allowed = queries.are_submissions_playable(db_session, data.submission_ids, user.id)
+async def get_game_data(data: GetGameData, user: User = Security(get_current_user, scopes=["submission.play"]),
+                        db_session: Session = Depends(database.get_db_session)):
+    allowed = await database.run_sync(queries.are_submissions_playable, db_session, data.submission_ids, user.id)
 
     return make_success_response({
         'allowed': allowed,
@@ -270,41 +323,118 @@ class AddSubmissionData(BaseModel):
 
 @app.post('/add_submission', response_class=JSONResponse)
 async def add_submission(data: AddSubmissionData, user: User = Security(get_current_user, scopes=["submission.add"])):
+    # Cloning can take a long time, so it is done in the background and polled with /get_submission_job
+    job_id = await submission_jobs.submit(user.id, data.url)
+
+    return make_success_response({"job_id": job_id})
+
+
+class SubmissionJobData(BaseModel):
+    job_id: str
+
+
+@app.post('/get_submission_job', response_class=JSONResponse)
+async def get_submission_job(data: SubmissionJobData,
+                             user: User = Security(get_current_user, scopes=["submission.add"])):
+    job = await submission_jobs.get_job(data.job_id)
+    if job is None or job["user_id"] != user.id:
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
+
+    response = {"state": job["state"]}
+    if job["state"] == submission_jobs.DONE:
+        response["submission_id"] = job["submission_id"]
+    elif job["state"] == submission_jobs.FAILED:
+        response["message"] = config_file.get(f"localisation.git_errors.{job['reason']}")
+
+    return make_success_response(response)
+
+
+class SubmissionRawFilesData(BaseModel):
+    files: List[SubmissionRawFileData]
+
+
+@app.post('/add_submission_raw_files', response_class=JSONResponse)
+async def add_submission_raw_files(data: SubmissionRawFilesData,
+                                   user: User = Security(get_current_user, scopes=["submission.add"]),
+                                   db_session: Session = Depends(database.get_db_session)):
+    def add(db_session):
+        submission_id = queries.create_raw_files_submission(db_session, user, data.files)
+        db_session.commit()
+        return submission_id
+
     try:
-        with cuwais.database.create_session() as db_session:
-            submission_id = queries.create_git_submission(db_session, user, data.url)
-            db_session.commit()
-    except repo.InvalidGitURL:
-        return make_fail_response(config_file.get("localisation.git_errors.invalid-url"))
+        submission_id = await database.run_sync(add, db_session)
     except repo.AlreadyExistsException:
+        logging.debug(f"New raw submission failed as it was already submitted")
         return make_fail_response(config_file.get("localisation.git_errors.already-submitted"))
     except repo.RepoTooBigException:
+        logging.debug(f"New raw submission failed as it was too large")
         return make_fail_response(config_file.get("localisation.git_errors.too-large"))
-    except repo.CantCloneException:
-        return make_fail_response(config_file.get("localisation.git_errors.clone-fail"))
-    except repo.AlreadyCloningException:
-        return make_resent_response()
 
     return make_success_response({"submission_id": submission_id})
 
 
-class SubmissionRawFilesData(BaseModel):
-    files: List[SubmissionRawFileData]
-
+class _RequestBodyReader(io.RawIOBase):
+    """A blocking file over the body of a request, for another thread to read as it arrives
+    rather than holding all of it in memory"""
+    def __init__(self, request: Request, loop: asyncio.AbstractEventLoop, max_bytes: int):
+        self._chunks = request.stream()
+        self._loop = loop
+        self._max_bytes = max_bytes
+        self._received = 0
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._buffer) == 0:
+            try:
+                chunk = asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+            except StopAsyncIteration:
+                return 0
+
+            self._received += len(chunk)
+            if self._received > self._max_bytes:
+                raise repo.RepoTooBigException(repo.RAW_FILES_URL)
+            self._buffer = chunk
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+@app.post('/add_submission_tar', response_class=JSONResponse)
+async def add_submission_tar(request: Request, user: User = Security(get_current_user, scopes=["submission.add"]),
+                             db_session: Session = Depends(database.get_db_session)):
+    """Adds a submission from a request body that is a tar of its files, which may be gzip or bz2 compressed"""
+    # Tar headers and padding take some space, but anything much bigger than the limit can't fit in it
+    max_bytes = 2 * int(config_file.get("max_repo_size_bytes")) + 1024 * 1024
+    loop = asyncio.get_running_loop()
+    reader = _RequestBodyReader(request, loop, max_bytes)
+
+    def add(db_session, files_hash):
+        submission_id = queries.create_submission(db_session, user, repo.RAW_FILES_URL, files_hash)
+        db_session.commit()
+        return submission_id
 
-@app.post('/add_submission_raw_files', response_class=JSONResponse)
-async def add_submission_raw_files(data: SubmissionRawFilesData,
-                                   user: User = Security(get_current_user, scopes=["submission.add"])):
+    # Uploads are as slow as the client, so are read on the default pool rather than holding a database thread
     try:
-        with cuwais.database.create_session() as db_session:
-            submission_id = queries.create_raw_files_submission(db_session, user, data.files)
-            db_session.commit()
+        files_hash = await loop.run_in_executor(None, repo.save_tar_archive, user.id, reader)
+    except repo.InvalidArchiveException:
+        return make_fail_response(INVALID_ARCHIVE_MESSAGE)
     except repo.AlreadyExistsException:
         logging.debug(f"New raw submission failed as it was already submitted")
         return make_fail_response(config_file.get("localisation.git_errors.already-submitted"))
     except repo.RepoTooBigException:
         logging.debug(f"New raw submission failed as it was too large")
         return make_fail_response(config_file.get("localisation.git_errors.too-large"))
+    except ClientDisconnect:
+        logging.debug(f"New raw submission failed as the client disconnected during the upload")
+        abort400()
+
+    submission_id = await database.run_sync(add, db_session, files_hash)
 
     return make_success_response({"submission_id": submission_id})
 
@@ -315,21 +445,24 @@ class BotData(BaseModel):
 
 
 @app.post('/add_bot', response_class=JSONResponse)
-async def add_bot(data: BotData, _: User = Security(get_current_user, scopes=["bot.add"])):
-    with cuwais.database.create_session() as db_session:
+async def add_bot(data: BotData, _: User = Security(get_current_user, scopes=["bot.add"]),
+                  db_session: Session = Depends(database.get_db_session)):
+    def add(db_session):
         bot = queries.create_bot(db_session, data.name)
-        db_session.flush()
-        try:
-            submission_id = queries.create_git_submission(db_session, bot, data.url)
-        except repo.InvalidGitURL:
-            return make_fail_response(config_file.get("localisation.git_errors.invalid-url"))
-        except repo.AlreadyExistsException:
-            return make_fail_response(config_file.get("localisation.git_errors.already-submitted"))
-        except repo.RepoTooBigException:
-            return make_fail_response(config_file.get("localisation.git_errors.too-large"))
-        except repo.CantCloneException:
-            return make_fail_response(config_file.get("localisation.git_errors.clone-fail"))
         db_session.commit()
+        leaderboard.add_user(bot.id)
+        return bot.id
+
+    def remove(db_session):
+        queries.delete_bot(db_session, bot_id)
+        db_session.commit()
+
+    bot_id = await database.run_sync(add, db_session)
+    try:
+        submission_id = await submission_jobs.run(bot_id, data.url)
+    except submission_jobs.JobFailedException as e:
+        await database.run_sync(remove, db_session)
+        return make_fail_response(config_file.get(f"localisation.git_errors.{e.reason}"))
 
     return make_success_response({"submission_id": submission_id})
 
@@ -339,11 +472,14 @@ class NameVisibleData(BaseModel):
 
 
 @app.post('/set_name_visible', response_class=JSONResponse)
-async def set_name_visible(data: NameVisibleData, user: User = Security(get_current_user, scopes=["me"])):
-    with cuwais.database.create_session() as db_session:
+async def set_name_visible(data: NameVisibleData, user: User = Security(get_current_user, scopes=["me"]),
+                           db_session: Session = Depends(database.get_db_session)):
+    def set_visible(db_session):
         queries.set_user_name_visible(db_session, user, data.visible)
         db_session.commit()
 
+    await database.run_sync(set_visible, db_session)
+
     return make_success_response()
 
 
@@ -352,20 +488,26 @@ class RemoveBotData(BaseModel):
 
 
 @app.post('/remove_bot', response_class=JSONResponse)
-async def remove_bot(data: RemoveBotData, _: User = Security(get_current_user, scopes=["bot.remove"])):
-    with cuwais.database.create_session() as db_session:
+async def remove_bot(data: RemoveBotData, _: User = Security(get_current_user, scopes=["bot.remove"]),
+                     db_session: Session = Depends(database.get_db_session)):
+    def remove(db_session):
         queries.delete_bot(db_session, data.bot_id)
         db_session.commit()
 
+    await database.run_sync(remove, db_session)
+
     return make_success_response()
 
 
 @app.post('/remove_user', response_class=JSONResponse)
-async def remove_user(user: User = Security(get_current_user, scopes=["me"])):
-    with cuwais.database.create_session() as db_session:
+async def remove_user(user: User = Security(get_current_user, scopes=["me"]),
+                      db_session: Session = Depends(database.get_db_session)):
+    def remove(db_session):
         queries.delete_user(db_session, user.id)
         db_session.commit()
 
+    await database.run_sync(remove, db_session)
+
     return make_success_response()
 
 
@@ -376,51 +518,88 @@ class SubmissionActiveData(BaseModel):
 
 @app.post('/set_submission_active', response_class=JSONResponse)
 async def set_submission_active(data: SubmissionActiveData,
-                                user: User = Security(get_current_user, scopes=["submission.modify"])):
-    with cuwais.database.create_session() as db_session:
+                                user: User = Security(get_current_user, scopes=["submission.modify"]),
+                                db_session: Session = Depends(database.get_db_session)):
+    def set_enabled(db_session):
         if not queries.submission_is_owned_by_user(db_session, data.submission_id, user.id):
-            return make_fail_response(config_file.get("localisation.submission_access_error"))
+            return False
 
         queries.set_submission_enabled(db_session, data.submission_id, data.enabled)
         db_session.commit()
+        return True
+
+    if not await database.run_sync(set_enabled, db_session):
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
 
     return make_success_response({"submission_id": data.submission_id})
 
 
 @app.post('/get_leaderboard', response_class=JSONResponse)
-async def get_leaderboard_data(user: User = Security(get_current_user, scopes=["leaderboard.view"])):
-    with cuwais.database.create_session() as db_session:
-        scoreboard = queries.get_scoreboard(db_session, user)
-
-    def transform(item, i):
-        trans = {
-            "position": i,
-            "name": item["user"]["display_name"],
-            "is_real_name": item["user"]["display_real_name"],
-            "nickname": item["user"]["nickname"],
-            "wins": item["outcomes"]["wins"],
-            "losses": item["outcomes"]["losses"],
-            "draws": item["outcomes"]["draws"],
-            "score": item["score_text"],
-            "is_bot": item["is_bot"],
-            "is_you": item["is_you"]
-        }
-
-        return trans
+async def get_leaderboard_data(user: User = Security(get_current_user, scopes=["leaderboard.view"]),
+                               db_session: Session = Depends(database.get_db_session)):
+    scoreboard = await queries.get_scoreboard(db_session, user)
 
-    transformed = [transform(sub, i + 1) for i, sub in enumerate(scoreboard)]
+    transformed = [transform_scoreboard_entry(sub, i + 1) for i, sub in enumerate(scoreboard)]
 
     return make_success_response({"entries": transformed})
 
 
+class LeaderboardPageData(BaseModel):
+    offset: int = 0
+    limit: int = 20
+    around_me: Optional[int] = None
+    top: int = 0
+
+
+MAX_LEADERBOARD_PAGE_SIZE = 100
+
+
+@app.post('/get_leaderboard_page', response_class=JSONResponse)
+async def get_leaderboard_page(data: LeaderboardPageData,
+                               user: User = Security(get_current_user, scopes=["leaderboard.view"]),
+                               db_session: Session = Depends(database.get_db_session)):
+    """Gets part of the leaderboard: either limit entries from offset, or if around_me is given then the entries up to
+    that many places above and below you. The best top entries are also always included"""
+    if data.offset < 0 or data.limit < 0 or data.top < 0 or (data.around_me is not None and data.around_me < 0):
+        abort400()
+    limit = min(data.limit, MAX_LEADERBOARD_PAGE_SIZE)
+    top = min(data.top, MAX_LEADERBOARD_PAGE_SIZE)
+
+    if data.around_me is not None:
+        distance = min(data.around_me, MAX_LEADERBOARD_PAGE_SIZE // 2)
+        page = await queries.get_scoreboard_around_user(db_session, user, distance)
+    else:
+        page = await queries.get_scoreboard_page(db_session, user, data.offset, data.offset + limit - 1)
+    top_page = await queries.get_scoreboard_page(db_session, user, 0, top - 1)
+
+    total = await leaderboard.get_size()
+
+    return make_success_response({
+        "entries": [transform_scoreboard_entry(sub, sub["rank"] + 1) for sub in page],
+        "top": [transform_scoreboard_entry(sub, sub["rank"] + 1) for sub in top_page],
+        "total": total
+    })
+
+
+@app.post('/rebuild_leaderboard', response_class=JSONResponse)
+async def rebuild_leaderboard(_: User = Security(get_current_user, scopes=["leaderboard.rebuild"])):
+    await database.run_sync(leaderboard.rebuild)
+    await database.run_sync(score_history.close_hours, backfill=True)
+
+    return make_success_response()
+
+
 @app.post('/get_submissions', response_class=JSONResponse)
-async def get_submissions_data(user: User = Security(get_current_user, scopes=["submissions.view"])):
-    with cuwais.database.create_session() as db_session:
-        subs = queries.get_all_user_submissions(db_session, user, private=True)
-        current_sub = queries.get_current_submission(db_session, user)
+async def get_submissions_data(user: User = Security(get_current_user, scopes=["submissions.view"]),
+                               db_session: Session = Depends(database.get_db_session)):
+    subs = await database.run_sync(queries.get_all_user_submissions, db_session, user, private=True)
+    current_sub_id = await database.run_sync(queries.get_current_submission_id, db_session, user.id)
+
+    crashes = await queries.get_crash_summaries([sub["submission_id"] for sub in subs
+                                                 if sub["tested"] and not sub["healthy"]])
 
     def transform(sub, i):
-        selected = current_sub is not None and sub['submission_id'] == current_sub.id
+        selected = sub['submission_id'] == current_sub_id
 
         trans = {"index": i,
                  "submission_id": sub["submission_id"],
@@ -431,7 +610,7 @@ async def get_submissions_data(user: User = Security(get_current_user, scopes=["
                  "selected": selected,
                  }
 
-        crash = sub['crash']
+        crash = crashes.get(sub["submission_id"], None)
         if crash is not None:
             trans = {**trans,
                      "crash_reason": crash['result'].replace("-", " ").capitalize(),
@@ -447,18 +626,36 @@ async def get_submissions_data(user: User = Security(get_current_user, scopes=["
 
 
 @app.post('/get_bots', response_class=JSONResponse)
-async def bots(_: User = Security(get_current_user, scopes=["bots.view"])):
-    with cuwais.database.create_session() as db_session:
-        bot_subs = queries.get_all_bot_submissions(db_session)
+async def bots(_: User = Security(get_current_user, scopes=["bots.view"]),
+               db_session: Session = Depends(database.get_db_session)):
+    def get_bots(db_session):
+        return [{"id": bot.id, "name": bot.display_name, "date": sub.submission_date}
+                for bot, sub in queries.get_all_bot_submissions(db_session)]
 
-    transformed_bots = [{"id": bot.id, "name": bot.display_name, "date": sub.submission_date} for bot, sub in bot_subs]
+    transformed_bots = await database.run_sync(get_bots, db_session)
     return make_success_response({"bots": transformed_bots})
 
 
+class LeaderboardOverTimeData(BaseModel):
+    since: Optional[float] = None
+    until: Optional[float] = None
+    resolution: Literal["hour", "day", "week"] = "hour"
+    max_points: Optional[int] = None  # Only used with columnar
+    columnar: bool = False
+
+
 @app.post('/get_leaderboard_over_time', response_class=JSONResponse)
-async def get_leaderboard_over_time(user: User = Security(get_current_user, scopes=["leaderboard.view"])):
-    with cuwais.database.create_session() as db_session:
-        graph = queries.get_leaderboard_graph(db_session, user.id)
+async def get_leaderboard_over_time(data: Optional[LeaderboardOverTimeData] = None,
+                                    user: User = Security(get_current_user, scopes=["leaderboard.view"]),
+                                    db_session: Session = Depends(database.get_db_session)):
+    """Gets each user's score changes between the since and until timestamps, summed per resolution.
+    With columnar set, each user instead gets arrays of times and running scores, downsampled to max_points"""
+    if data is None:
+        data = LeaderboardOverTimeData()
+
+    graph = await queries.get_leaderboard_graph(db_session, user.id, since=data.since, until=data.until,
+                                                resolution=data.resolution, max_points=data.max_points,
+                                                columnar=data.columnar)
 
     return make_success_response(graph)
 
@@ -469,36 +666,81 @@ class SubmissionRequestData(BaseModel):
 
 @app.post('/get_submission_win_loss_data', response_class=JSONResponse)
 async def get_submission_win_loss_data(data: SubmissionRequestData,
-                                       user: User = Security(get_current_user, scopes=["submissions.view"])):
-    with cuwais.database.create_session() as db_session:
-        if not queries.submission_is_owned_by_user(db_session, data.submission_id, user.id):
-            return make_fail_response(config_file.get("localisation.submission_access_error"))
+                                       user: User = Security(get_current_user, scopes=["submissions.view"]),
+                                       db_session: Session = Depends(database.get_db_session)):
+    if not await database.run_sync(queries.submission_is_owned_by_user, db_session, data.submission_id, user.id):
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
 
-    summary_data = queries.get_submission_win_loss_data(data.submission_id)
+    summary_data = await queries.get_submission_win_loss_data(data.submission_id)
 
     return make_success_response(summary_data)
 
 
+class SubmissionsRequestData(BaseModel):
+    submission_ids: List[int]
+
+
+MAX_WIN_LOSS_BATCH_SIZE = 200
+
+
+@app.post('/get_submissions_win_loss_data', response_class=JSONResponse)
+async def get_submissions_win_loss_data(data: SubmissionsRequestData,
+                                        user: User = Security(get_current_user, scopes=["submissions.view"]),
+                                        db_session: Session = Depends(database.get_db_session)):
+    if len(data.submission_ids) > MAX_WIN_LOSS_BATCH_SIZE:
+        return make_fail_response(f"At most {MAX_WIN_LOSS_BATCH_SIZE} submissions may be requested at once")
+
+    if not await database.run_sync(queries.submissions_are_owned_by_user, db_session, data.submission_ids, user.id):
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
+
+    summary_data = await queries.get_submissions_win_loss_data(data.submission_ids)
+
+    return make_success_response({"submissions": {str(submission_id): submission_data
+                                                  for submission_id, submission_data in summary_data.items()}})
+
+
+@app.post('/get_submission_crash_report', response_class=JSONResponse)
+async def get_submission_crash_report(data: SubmissionRequestData,
+                                      user: User = Security(get_current_user, scopes=["submissions.view"]),
+                                      db_session: Session = Depends(database.get_db_session)):
+    if not await database.run_sync(queries.submission_is_owned_by_user, db_session, data.submission_id, user.id):
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
+
+    crash = await database.run_sync(queries.get_crash_report, db_session, data.submission_id)
+    if crash is None:
+        return make_fail_response(UNTESTED_SUBMISSION_MESSAGE)
+
+    return make_success_response({"recording": crash["recording"],
+                                  "crash_reason": crash["result"].replace("-", " ").capitalize(),
+                                  "crash_reason_long": reason_crash(crash["result"]),
+                                  "prints": crash["prints"]})
+
+
 @app.post('/is_submission_testing', response_class=JSONResponse)
 async def is_submission_testing(data: SubmissionRequestData,
-                                user: User = Security(get_current_user, scopes=["submissions.view"])):
-    with cuwais.database.create_session() as db_session:
-        if not queries.submission_is_owned_by_user(db_session, data.submission_id, user.id):
-            return make_fail_response(config_file.get("localisation.submission_access_error"))
+                                user: User = Security(get_current_user, scopes=["submissions.view"]),
+                                db_session: Session = Depends(database.get_db_session)):
+    if not await database.run_sync(queries.submission_is_owned_by_user, db_session, data.submission_id, user.id):
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
 
-        is_testing = queries.is_submission_testing(db_session, data.submission_id)
+    is_testing = await database.run_sync(queries.is_submission_testing, db_session, data.submission_id)
 
     return make_success_response({"is_testing": is_testing})
 
 
 @app.post('/delete_submission', response_class=JSONResponse)
 async def delete_submission(data: SubmissionRequestData,
-                            user: User = Security(get_current_user, scopes=["submissions.remove"])):
-    with cuwais.database.create_session() as db_session:
+                            user: User = Security(get_current_user, scopes=["submissions.remove"]),
+                            db_session: Session = Depends(database.get_db_session)):
+    def delete(db_session):
         if not queries.submission_is_owned_by_user(db_session, data.submission_id, user.id):
-            return make_fail_response(config_file.get("localisation.submission_access_error"))
+            return False
 
         queries.delete_submission(db_session, data.submission_id)
+        return True
+
+    if not await database.run_sync(delete, db_session):
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
 
     return make_success_response()
 
@@ -509,6 +751,16 @@ async def service_status(user: User = Security(get_current_user, scopes=["servic
     return make_success_response(services)
 
 
+@app.post('/db_pool_status', response_class=JSONResponse)
+async def db_pool_status(user: User = Security(get_current_user, scopes=["service.status"])):
+    return make_success_response(database.get_pool_stats())
+
+
+@app.post('/cache_status', response_class=JSONResponse)
+async def cache_status(user: User = Security(get_current_user, scopes=["service.status"])):
+    return make_success_response(caching.get_cache_stats())
+
+
 @app.get('/get_default_submission', response_class=FileResponse)
 async def get_default_submission(extension: Literal["tar", "zip"]):  # user: User = Security(get_current_user, scopes=["submission.get_default"])):
     media = 'application/octet-stream'
@@ -518,6 +770,40 @@ async def get_default_submission(extension: Literal["tar", "zip"]):  # user: Use
     return FileResponse(DEFAULT_SUBMISSION_ZIP_PATH, media_type=media, filename=file + ".zip")
 
 
+@app.get('/get_submission_archive')
+async def get_submission_archive(submission_id: int, request: Request,
+                                 user: User = Security(get_current_user, scopes=["submissions.view"]),
+                                 db_session: Session = Depends(database.get_db_session)):
+    def get_hash(db_session):
+        if not queries.submission_is_owned_by_user(db_session, submission_id, user.id):
+            return None
+        return queries.get_submission_hash(db_session, submission_id)
+
+    files_hash = await database.run_sync(get_hash, db_session)
+    archive = None if files_hash is None else repo.get_archive(files_hash)
+    if archive is None:
+        return make_fail_response(config_file.get("localisation.submission_access_error"))
+
+    path, encoding = archive
+    media = 'application/x-tar'
+    file = f"submission_{submission_id}.tar"
+    if encoding is None:
+        return FileResponse(path, media_type=media, filename=file)
+
+    # Compressed archives are sent as they are stored to clients which can decompress them
+    accepted = [part.split(";")[0].strip() for part in request.headers.get("accept-encoding", "").split(",")]
+    if encoding in accepted:
+        return FileResponse(path, media_type=media, filename=file,
+                            headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+
+    def decompressed():
+        with repo.open_archive(files_hash) as f:
+            yield from iter(lambda: f.read(64 * 1024), b"")
+
+    return StreamingResponse(decompressed(), media_type=media, headers={
+        "Content-Disposition": f'attachment; filename="{file}"', "Vary": "Accept-Encoding"})
+
+
 async def forward(ws_a: WebSocket, ws_b: websockets.WebSocketClientProtocol):
     while True:
         data = await ws_a.receive_text()
@@ -555,18 +841,12 @@ async def websocket_endpoint(websocket: WebSocket,
         return
     submission_ids = [int(i) for i in data['submission_ids']]
 
-    with cuwais.database.create_session() as db_session:
-        if not queries.are_submissions_playable(db_session, submission_ids, user.id):
-            await make_websocket_response("error", "Submission not found")
-            return
-
-        hashes = []
-        for sid in submission_ids:
-            h = queries.get_submission_hash(db_session, sid)
-            if h is None:
-                await make_websocket_response("error", "Submission id invalid")
-                return
-            hashes.append(h)
+    # Don't hold a connection from the request's session for the whole game
+    hashes = await database.run_in_session(queries.get_playable_submission_hashes, submission_ids, user.id)
+
+    if hashes is None:
+        await make_websocket_response("error", "Submission not found")
+        return
 
     async with websockets.connect("ws://runner:8080/ws/run") as ws_b_client:
         ws_b_client: websockets.WebSocketClientProtocol
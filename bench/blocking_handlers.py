@@ -0,0 +1,82 @@
+"""Compares handlers which block the event loop with handlers which run the same blocking work through run_sync,
+using a local server whose only work is sleeping in place of a database query.
+
+    python -m bench.blocking_handlers --delay 0.02 --requests 200 --concurrency 50
+
+The server is started the same way as app/run.sh starts the real one, with gunicorn's UvicornWorker, so that it runs
+on the same event loop as a deployment. Nothing touches the database, so it only needs the app's config to be
+importable. To measure the real endpoints, start the app with app/run.sh and use bench/concurrent_requests.py."""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI
+
+from app import database
+from bench.concurrent_requests import make_request
+
+
+def make_app(delay: float) -> FastAPI:
+    bench_app = FastAPI()
+
+    @bench_app.post("/inline")
+    async def inline():
+        time.sleep(delay)
+        return {}
+
+    @bench_app.post("/pool")
+    async def pool():
+        await database.run_sync(time.sleep, delay)
+        return {}
+
+    return bench_app
+
+
+# Imported by the gunicorn worker
+app = make_app(float(os.environ.get("BENCH_DELAY", "0.02")))
+
+
+def start_server(port: int, delay: float) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "--workers=1", "--threads=3",
+                               "--worker-class=uvicorn.workers.UvicornWorker", "--worker-connections=1000",
+                               f"--bind=127.0.0.1:{port}", "--log-level=warning", "bench.blocking_handlers:app"],
+                              env={**os.environ, "BENCH_DELAY": str(delay)})
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except ConnectionRefusedError:
+            if server.poll() is not None:
+                raise RuntimeError("The server failed to start")
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delay", type=float, default=0.02, help="Seconds each request blocks for")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.delay)
+    try:
+        for path in ["/inline", "/pool"]:
+            url = f"http://127.0.0.1:{args.port}{path}"
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                start = time.perf_counter()
+                list(executor.map(lambda _: make_request(url, None, "{}"), range(args.requests)))
+                elapsed = time.perf_counter() - start
+            print(f"{path}: {args.requests} requests, {args.concurrency} at a time, in {elapsed:.2f}s, "
+                  f"{args.requests / elapsed:.1f} requests/s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Measures how many requests per second a running server answers when many are made at once.
+
+    python bench/concurrent_requests.py http://localhost:8080/get_leaderboard --jwt <session_jwt> --concurrency 50
+
+Run it against the same deployment before and after a change to compare throughput and latency."""
+import argparse
+import http.client
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+def make_request(url: str, session_jwt: str, body: str) -> float:
+    parts = urlsplit(url)
+    connection_type = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    connection = connection_type(parts.netloc, timeout=60)
+    headers = {"Content-Type": "application/json"}
+    if session_jwt is not None:
+        headers["Cookie"] = f"session_jwt={session_jwt}"
+
+    start = time.perf_counter()
+    connection.request("POST", parts.path, body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - start
+    connection.close()
+
+    if response.status != 200:
+        raise RuntimeError(f"Request failed with status {response.status}")
+
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url")
+    parser.add_argument("--jwt", default=None, help="The session_jwt cookie of a logged in user")
+    parser.add_argument("--body", default="{}", help="The JSON body of each request")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        start = time.perf_counter()
+        latencies = list(executor.map(lambda _: make_request(args.url, args.jwt, args.body), range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{args.requests} requests, {args.concurrency} at a time, in {elapsed:.2f}s")
+    print(f"Throughput: {args.requests / elapsed:.1f} requests/s")
+    print(f"Latency: median {statistics.median(latencies) * 1000:.1f}ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms, "
+          f"max {latencies[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()